@@ -3,9 +3,9 @@ import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 
-from src.pdf_utils import extract_text_pipeline
-from src.analysis import ai_segment_text, slice_pages_text, ai_analyse_stance
-from src.io_utils import save_json, save_csv_stance
+from src.pdf_utils import detect_extraction_mode, extract_text_pipeline
+from src.analysis import ai_segment_pdf, ai_segment_text, slice_pages_text, iter_stance_ordered, retry_stats, retry_stats_since, supports_file_upload
+from src.io_utils import save_json, save_jsonl, save_csv_stance
 
 
 def run_pipeline(
@@ -20,24 +20,33 @@ def run_pipeline(
     Workflow:
       1) Extract/clean PDF text locally and add <<PAGE N>> anchors.
       2) Segment sections via AI on anchored text.
-      3) Run stance analysis per section.
+      3) Run stance analysis per section (concurrently, see iter_stance_ordered).
     """
     try:
         os.makedirs(out_dir, exist_ok=True)
 
+        stats_before = retry_stats(model_name)
+
         # Stage 0: extract and clean
+        mode = detect_extraction_mode(pdf_path)
         if status_cb:
+            status_cb(f"Extraction mode: {mode}")
             status_cb("Extracting and cleaning PDF text...")
         if progress_cb:
             progress_cb(10)
-        _, _, combined = extract_text_pipeline(pdf_path)
+        combined, page_index = extract_text_pipeline(pdf_path)
 
-        # Stage 1: segment with anchored text
-        if status_cb:
-            status_cb("Segmenting sections with AI (local text with anchors)...")
+        # Stage 1: segment with anchored text, or let Gemini read a scanned PDF directly
         if progress_cb:
             progress_cb(40)
-        segmentation = ai_segment_text(combined, model_name=model_name)
+        if mode == "scanned" and supports_file_upload(model_name):
+            if status_cb:
+                status_cb("No text layer found; segmenting sections with AI from the uploaded PDF...")
+            segmentation = ai_segment_pdf(pdf_path, model_name=model_name)
+        else:
+            if status_cb:
+                status_cb("Segmenting sections with AI (local text with anchors)...")
+            segmentation = ai_segment_text(combined, model_name=model_name)
 
         seg_path = os.path.join(out_dir, "segmentation.json")
         save_json(segmentation, seg_path)
@@ -45,29 +54,41 @@ def run_pipeline(
         # Stage 2: stance analysis
         if status_cb:
             status_cb("Analyzing stance markers per section...")
-        stance_results = []
-        total = max(len(segmentation), 1)
-        for idx, seg in enumerate(segmentation, start=1):
+        targets = []
+        for seg in segmentation:
             title = seg["title"]
             if analyze_only_conclusion and "conclusion" not in title.lower():
-                if progress_cb:
-                    progress_cb(int(60 + 35 * (idx / total)))
                 continue
-            text = slice_pages_text(combined, seg["start_page"], seg["end_page"])
-            result = ai_analyse_stance(title, text, model_name=model_name)
-            stance_results.append(result)
-            if progress_cb:
-                progress_cb(int(60 + 35 * (idx / total)))
+            targets.append((title, slice_pages_text(combined, seg["start_page"], seg["end_page"], page_index)))
+
+        if progress_cb:
+            progress_cb(60)
+        stance_results = []
+
+        def collect():
+            for res in iter_stance_ordered(
+                targets,
+                model_name=model_name,
+                progress_cb=(lambda done, total: progress_cb(int(60 + 35 * done / total))) if progress_cb else None,
+            ):
+                stance_results.append(res)
+                yield res
 
         stance_json_path = os.path.join(out_dir, "stance.json")
+        stance_jsonl_path = os.path.join(out_dir, "stance.jsonl")
         stance_csv_path = os.path.join(out_dir, "stance.csv")
+        # CSV rows are written while later sections are still being analysed
+        save_csv_stance(collect(), stance_csv_path)
         save_json(stance_results, stance_json_path)
-        save_csv_stance(stance_results, stance_csv_path)
+        save_jsonl(stance_results, stance_jsonl_path)
 
         if progress_cb:
             progress_cb(100)
         if status_cb:
-            status_cb(f"Done.\nSaved:\n{seg_path}\n{stance_json_path}\n{stance_csv_path}")
+            retries = retry_stats_since(stats_before, model_name)
+            if retries:
+                status_cb(f"Gemini retries ({retries})")
+            status_cb(f"Done.\nSaved:\n{seg_path}\n{stance_json_path}\n{stance_jsonl_path}\n{stance_csv_path}")
     except Exception as e:
         if status_cb:
             status_cb(f"Error: {e}")
@@ -89,6 +110,8 @@ class App(tk.Tk):
         self.api_key = tk.StringVar(value=os.getenv("GEMINI_API_KEY", ""))
         self.api_show = tk.BooleanVar(value=False)
         self.save_env = tk.BooleanVar(value=False)
+        # Key to mask in status messages; refreshed on run/save instead of per message
+        self._masked_key = self.api_key.get().strip()
 
         self._build_ui()
 
@@ -145,6 +168,7 @@ class App(tk.Tk):
 
     def save_key_to_env(self):
         key = self.api_key.get().strip()
+        self._masked_key = key
         if not key:
             messagebox.showerror("No key", "Enter a Gemini API key first.")
             return
@@ -186,8 +210,9 @@ class App(tk.Tk):
         self.update_idletasks()
 
     def set_status(self, msg: str):
-        safe_msg = msg.replace(self.api_key.get().strip(), "****") if self.api_key.get() else msg
-        self.status.insert("end", safe_msg + "\n")
+        if self._masked_key and self._masked_key in msg:
+            msg = msg.replace(self._masked_key, "****")
+        self.status.insert("end", msg + "\n")
         self.status.see("end")
         self.update_idletasks()
 
@@ -197,6 +222,7 @@ class App(tk.Tk):
         model = self.model_name.get().strip() or None
         conc_only = self.conclusion_only.get()
         key = self.api_key.get().strip()
+        self._masked_key = key
 
         if not pdf or not os.path.isfile(pdf):
             messagebox.showerror("Missing PDF", "Please select a valid PDF file.")
@@ -226,7 +252,7 @@ class App(tk.Tk):
                 )
                 self.after(0, lambda: messagebox.showinfo("Completed", "Analysis completed. Files saved."))
             except Exception as e:
-                self.after(0, lambda: messagebox.showerror("Error", str(e)))
+                self.after(0, lambda msg=str(e): messagebox.showerror("Error", msg))
             finally:
                 self.after(0, lambda: self.run_btn.config(state="normal"))
 
@@ -1,6 +1,14 @@
+import io
 import os
 import time
 import random
+import hashlib
+import threading
+import functools
+
+import orjson
+
+from .io_utils import loads, parse_json_str
 
 USE_NEW_CLIENT = os.getenv("USE_NEW_GENAI", "1") == "1"
 
@@ -8,6 +16,70 @@ RETRY_STATUS = {"UNAVAILABLE", "RESOURCE_EXHAUSTED"}
 MAX_RETRIES = int(os.getenv("GENAI_MAX_RETRIES", "5"))
 BASE_DELAY = float(os.getenv("GENAI_BASE_DELAY", "1.0"))
 FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL", "gemini-2.0-flash")
+BATCH_MODE = os.getenv("GENAI_BATCH_MODE", "0") == "1"
+BATCH_POLL_SECONDS = float(os.getenv("GENAI_BATCH_POLL_SECONDS", "10"))
+BATCH_TIMEOUT = float(os.getenv("GENAI_BATCH_TIMEOUT", "3600"))
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+CACHE_DIR = os.getenv("GEMINI_CACHE_DIR", os.path.join("outputs", ".gemini_cache"))
+
+
+def _cache_path(model: str, system_instruction: str | None, prompt: str, temperature: float) -> str:
+    # Hash the parts incrementally: same digest as hashing the concatenation, without
+    # building a second copy of a prompt that can carry a whole thesis section.
+    h = hashlib.blake2b()
+    for part in (model, system_instruction or "", prompt, str(temperature)):
+        h.update(part.encode("utf-8", "surrogatepass"))
+    return os.path.join(CACHE_DIR, f"{h.hexdigest()}.json")
+
+
+def _cache_read(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return loads(f.read())["text"]
+    except Exception:
+        return None
+
+
+def _cache_write(path: str, text: str):
+    if not text:
+        return
+    # Truncated or malformed responses are not cached, so the next call asks the model again
+    try:
+        parse_json_str(text)
+    except ValueError:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so concurrent readers never see a partial file
+        tmp = f"{path}.{os.getpid()}.{random.getrandbits(32):08x}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps({"text": text}))
+        os.replace(tmp, path)
+    except (OSError, TypeError):  # TypeError: orjson rejects lone surrogates
+        pass
+
+
+def disk_cached(fn):
+    """Cache generate_json responses on disk, keyed by (model, system, prompt, temperature)."""
+
+    @functools.wraps(fn)
+    def wrapper(self, prompt: str, system_instruction: str = None, temperature: float = 0.2, max_output_tokens: int = 20000, use_cache: bool = True):
+        if not use_cache:
+            return fn(self, prompt, system_instruction=system_instruction, temperature=temperature, max_output_tokens=max_output_tokens)
+        path = _cache_path(self.model_name, system_instruction, prompt, temperature)
+        text = _cache_read(path)
+        if text is None:
+            self._answered.model = self.model_name
+            text = fn(self, prompt, system_instruction=system_instruction, temperature=temperature, max_output_tokens=max_output_tokens)
+            # Key the entry on the model that actually answered: a fallback-model reply must not
+            # be served later as the primary model's output
+            if self._answered.model != self.model_name:
+                path = _cache_path(self._answered.model, system_instruction, prompt, temperature)
+            _cache_write(path, text)
+        return text
+
+    return wrapper
+
 
 class GeminiClient:
     def __init__(self, model_name: str = None):
@@ -15,18 +87,36 @@ class GeminiClient:
         self.api_key = os.getenv("GEMINI_API_KEY")
         if not self.api_key:
             raise RuntimeError("GEMINI_API_KEY not set in environment")
+        # Telemetry: retries, exhausted retry loops and fallback-model calls
+        self.retry_stats: dict[str, int] = {}
+        self._stats_lock = threading.Lock()
+        # Per-thread record of which model answered the last generate_json call (see disk_cached)
+        self._answered = threading.local()
+        # Legacy SDK: GenerativeModel per (model, system_instruction), built once per client
+        self._models: dict[tuple[str, str | None], object] = {}
 
         if USE_NEW_CLIENT:
             from google import genai
             self.genai = genai
-            self.client = genai.Client(api_key=self.api_key)
+            # Optional: pin the REST API version (e.g. "v1"); the SDK default is used otherwise
+            api_version = os.getenv("GENAI_API_VERSION")
+            http_options = {"api_version": api_version} if api_version else None
+            self.client = genai.Client(api_key=self.api_key, http_options=http_options)
             self.mode = "new"
         else:
             import google.generativeai as genai
             genai.configure(api_key=self.api_key)
             self.genai = genai
-            self.model = genai.GenerativeModel(self.model_name)
             self.mode = "legacy"
+            self.model = self._legacy_model(self.model_name)
+
+    def _legacy_model(self, model: str, system_instruction: str | None = None):
+        key = (model, system_instruction)
+        mdl = self._models.get(key)
+        if mdl is None:
+            # setdefault: threads racing on a new key all end up sharing one instance
+            mdl = self._models.setdefault(key, self.genai.GenerativeModel(model, system_instruction=system_instruction))
+        return mdl
 
     def _call_once(self, model: str, contents, system_instruction: str, temperature: float, max_output_tokens: int):
         if self.mode == "new":
@@ -40,8 +130,7 @@ class GeminiClient:
                 },
             ).text
         else:
-            mdl = self.model if model == self.model_name else self.genai.GenerativeModel(model)
-            return mdl.generate_content(
+            return self._legacy_model(model, system_instruction).generate_content(
                 contents if isinstance(contents, str) else contents,  # legacy supports text; file mixing may differ
                 generation_config={
                     "temperature": temperature,
@@ -50,7 +139,15 @@ class GeminiClient:
                 },
             ).text
 
-    def _retry_wrapper(self, fn, *args, **kwargs):
+    def _count(self, event: str):
+        with self._stats_lock:
+            self.retry_stats[event] = self.retry_stats.get(event, 0) + 1
+
+    def _retry_wrapper(self, fn, *args, fallback=None, **kwargs):
+        """
+        Call fn with exponential backoff on transient errors (503/UNAVAILABLE/RESOURCE_EXHAUSTED).
+        If every attempt fails and `fallback` is given, it is called once as a post-exhaustion hook.
+        """
         err_last = None
         for attempt in range(1, MAX_RETRIES + 1):
             try:
@@ -58,31 +155,112 @@ class GeminiClient:
             except Exception as e:
                 msg = str(e)
                 transient = ("503" in msg) or ("UNAVAILABLE" in msg) or ("RESOURCE_EXHAUSTED" in msg)
-                if not transient and attempt >= MAX_RETRIES:
-                    raise
-                if transient:
+                err_last = e
+                if transient and attempt < MAX_RETRIES:
+                    self._count("retries")
                     delay = BASE_DELAY * (2 ** (attempt - 1))
                     delay = delay * (0.7 + 0.6 * random.random())
                     time.sleep(min(delay, 15.0))
-                    err_last = e
                     continue
-                err_last = e
                 break
-        if err_last:
-            raise err_last
+        self._count("exhausted")
+        if fallback is not None:
+            self._count("fallbacks")
+            return fallback()
+        raise err_last
+
+    def _fallback_for(self, call):
+        """Post-exhaustion hook re-running call(model) once on FALLBACK_MODEL, if it differs."""
+        if FALLBACK_MODEL and FALLBACK_MODEL != self.model_name:
+            return lambda: call(FALLBACK_MODEL)
+        return None
 
+    @disk_cached
     def generate_json(self, prompt: str, system_instruction: str = None, temperature: float = 0.2, max_output_tokens: int = 20000):
-        contents = (system_instruction + "\n\n" + prompt) if system_instruction else prompt
-        try:
-            return self._retry_wrapper(self._call_once, self.model_name, contents, system_instruction=None, temperature=temperature, max_output_tokens=max_output_tokens)
-        except Exception:
-            if FALLBACK_MODEL and FALLBACK_MODEL != self.model_name:
-                return self._call_once(FALLBACK_MODEL, contents, system_instruction=None, temperature=temperature, max_output_tokens=max_output_tokens)
-            raise
+        if self.mode == "legacy":
+            # The cached GenerativeModel carries the system instruction itself
+            contents, sys_inst = prompt, system_instruction
+        else:
+            contents, sys_inst = (system_instruction + "\n\n" + prompt) if system_instruction else prompt, None
+
+        def call(model):
+            text = self._call_once(model, contents, system_instruction=sys_inst, temperature=temperature, max_output_tokens=max_output_tokens)
+            self._answered.model = model
+            return text
+
+        return self._retry_wrapper(call, self.model_name, fallback=self._fallback_for(call))
+
+    def generate_json_batch(
+        self,
+        prompts: list[tuple[str, str | None]],
+        temperature: float = 0.2,
+        max_output_tokens: int = 20000,
+        use_cache: bool = True,
+    ) -> list[str]:
+        """
+        Run many (prompt, system_instruction) pairs and return response texts in input order.
+        With GENAI_BATCH_MODE=1 and a new SDK exposing `batches`, all prompts go out as one
+        Batch Mode job (half price, asynchronous); otherwise they are sent one by one. A job not
+        finished after GENAI_BATCH_TIMEOUT seconds is cancelled and TimeoutError raised.
+        Failed entries come back as "" so callers' JSON parsing treats them as unusable.
+        """
+        if not prompts:
+            return []
+        if not (BATCH_MODE and self.mode == "new" and hasattr(self.client, "batches")):
+            return [
+                self.generate_json(p, system_instruction=sys_inst, temperature=temperature, max_output_tokens=max_output_tokens, use_cache=use_cache)
+                for p, sys_inst in prompts
+            ]
+
+        # Only prompts missing from the response cache are submitted to the batch job
+        paths = [_cache_path(self.model_name, sys_inst, p, temperature) for p, sys_inst in prompts]
+        texts = [_cache_read(path) if use_cache else None for path in paths]
+        pending = [i for i, t in enumerate(texts) if t is None]
+        if not pending:
+            return texts
+
+        config = {
+            "temperature": temperature,
+            "max_output_tokens": max_output_tokens,
+            "response_mime_type": "application/json",
+        }
+        requests = [
+            {
+                "contents": [{"role": "user", "parts": [{"text": (sys_inst + "\n\n" + p) if sys_inst else p}]}],
+                "config": config,
+            }
+            for p, sys_inst in (prompts[i] for i in pending)
+        ]
+        job = self._retry_wrapper(
+            self.client.batches.create,
+            model=self.model_name,
+            src=requests,
+            config={"display_name": f"ai-stance-{len(requests)}"},
+        )
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        while job.state.name not in BATCH_DONE_STATES:
+            if time.monotonic() >= deadline:
+                try:
+                    self.client.batches.cancel(name=job.name)
+                except Exception:
+                    pass
+                raise TimeoutError(f"Gemini batch job {job.name} still {job.state.name} after {BATCH_TIMEOUT:.0f}s; cancelled")
+            time.sleep(BATCH_POLL_SECONDS)
+            job = self._retry_wrapper(self.client.batches.get, name=job.name)
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Gemini batch job {job.name} ended in {job.state.name}")
+
+        for i, r in zip(pending, job.dest.inlined_responses):
+            try:
+                texts[i] = (r.response.text or "") if r.response else ""
+            except Exception:
+                texts[i] = ""
+            _cache_write(paths[i], texts[i])
+        return [t or "" for t in texts]
 
     def generate_json_with_file(
         self,
-        file_path: str,
+        file_path: str | bytes,
         instruction: str,
         system_instruction: str | None = None,
         temperature: float = 0.1,
@@ -98,13 +276,21 @@ class GeminiClient:
                 max_output_tokens=max_output_tokens,
             )
 
+        # Upload once; retries and the fallback model reuse the same file handle.
+        # Raw PDF bytes are uploaded from memory without a temporary file.
+        if isinstance(file_path, (bytes, bytearray)):
+            file_obj = self._retry_wrapper(
+                lambda: self.client.files.upload(file=io.BytesIO(file_path), config={"mime_type": "application/pdf"})
+            )
+        else:
+            file_obj = self._retry_wrapper(self.client.files.upload, file=file_path)
+        contents = []
+        if system_instruction:
+            contents.append(system_instruction)
+        contents.append(instruction)
+        contents.append(file_obj)
+
         def call(model):
-            file_obj = self.client.files.upload(file=file_path)
-            contents = []
-            if system_instruction:
-                contents.append(system_instruction)
-            contents.append(instruction)
-            contents.append(file_obj)
             return self.client.models.generate_content(
                 model=model,
                 contents=contents,
@@ -115,11 +301,4 @@ class GeminiClient:
                 },
             ).text
 
-        try:
-            return self._with_retry(lambda: call(self.model_name))
-        except Exception:
-            from os import getenv
-            fallback = getenv("GEMINI_FALLBACK_MODEL", "gemini-2.0-flash")
-            if fallback and fallback != self.model_name:
-                return call(fallback)
-            raise
+        return self._retry_wrapper(call, self.model_name, fallback=self._fallback_for(call))
@@ -1,23 +1,96 @@
-import json
+import bisect
+import csv
+import functools
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+import os
 import re
-from typing import Any
+import statistics
+from typing import Any, Iterator
 
-from .prompts import (
-    SEGMENT_SYSTEM, SEGMENT_USER_TEMPLATE, STANCE_SYSTEM, STANCE_USER_TEMPLATE,
-    QUERY_SYSTEM, QUERY_USER_TEMPLATE
-)
+try:
+    import ahocorasick  # pyahocorasick: single-pass multi-keyword scan in C
+except ImportError:
+    ahocorasick = None
 
-from .ai_clients import GeminiClient
+from .ai_clients import BATCH_MODE, GeminiClient
 from .prompts import (
+    QUERY_SYSTEM,
+    QUERY_USER_TEMPLATE,
     SEGMENT_SYSTEM,
     SEGMENT_USER_TEMPLATE,
+    SEGMENT_MULTI_USER_TEMPLATE,
+    SEGMENT_FILE_INSTRUCTION,
     STANCE_SYSTEM,
     STANCE_USER_TEMPLATE,
 )
-from .pdf_utils import chunk_text_for_model
+from .pdf_utils import chunk_text_for_model, group_chunks, build_page_index
+from .io_utils import STANCE_CATEGORIES, parse_json_str
+
+SEGMENT_CHUNKS_PER_CALL = max(1, int(os.getenv("SEGMENT_CHUNKS_PER_CALL", "4")))
+STANCE_MAX_TOKENS = int(os.getenv("STANCE_MAX_TOKENS", "30000"))
+STANCE_CONCURRENCY = int(os.getenv("STANCE_CONCURRENCY", "6"))
+STANCE_CHUNK_CHARS = int(os.getenv("STANCE_CHUNK_CHARS", "20000"))
+STANCE_CHUNK_OVERLAP = int(os.getenv("STANCE_CHUNK_OVERLAP", "500"))
+STANCE_MIN_CUES = int(os.getenv("STANCE_MIN_CUES", "5"))
+STANCE_SKIP_TITLES = {"references", "bibliography", "appendices", "appendix"}
+STANCE_MEMO_SIZE = int(os.getenv("STANCE_MEMO_SIZE", "256"))
+# Sections longer than this are reduced to windows of STANCE_SALIENCE_CONTEXT chars around cue words
+STANCE_SALIENCE_CHARS = int(os.getenv("STANCE_SALIENCE_CHARS", "30000"))
+STANCE_SALIENCE_CONTEXT = int(os.getenv("STANCE_SALIENCE_CONTEXT", "120"))
+# Worker multipliers for the short / medium / long length bins of iter_stance_results;
+# bins never exceed the caller's worker budget, long ones get a share of it
+STANCE_BIN_SCALE = (1.0, 0.75, 0.5)
+
+# Cheap prefilter: sections with fewer than STANCE_MIN_CUES of these are not sent to Gemini
+CUE_RE = re.compile(
+    r"\b(may|might|could|possibly|perhaps|likely|clearly|definitely|certainly|obviously"
+    r"|unfortunately|importantly|interestingly|surprisingly|we|i|our|my|the researcher)\b",
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _page_index_for(full_text: str) -> dict[int, tuple[int, int]]:
+    # str caches its hash, so repeated lookups for the same document are O(1) after the first;
+    # callers that slice many sections without passing page_index scan the text only once.
+    # One entry only: the key pins a whole thesis text for the life of the process (str does
+    # not support weak references), and both apps pass page_index explicitly anyway.
+    return build_page_index(full_text)
+
+
+@functools.lru_cache(maxsize=4)
+def _client_for(model_name: str | None, api_key: str | None) -> GeminiClient:
+    return GeminiClient(model_name=model_name)
+
+
+def _get_client(model_name: str | None = None) -> GeminiClient:
+    """
+    Shared GeminiClient per model, so every section reuses one SDK client and its
+    connection pool. The API key is part of the key because the GUI can change it at runtime.
+    """
+    return _client_for(model_name, os.getenv("GEMINI_API_KEY"))
+
+
+def retry_stats(model_name: str | None = None) -> dict[str, int]:
+    """Snapshot of the shared client's retry telemetry: retries, exhausted loops, fallbacks."""
+    client = _get_client(model_name)
+    with client._stats_lock:
+        return dict(client.retry_stats)
+
+
+def retry_stats_since(before: dict[str, int], model_name: str | None = None) -> str:
+    """Human-readable counts accumulated since the `before` snapshot, or "" if there were none."""
+    now = retry_stats(model_name)
+    return ", ".join(f"{k}: {v - before.get(k, 0)}" for k, v in sorted(now.items()) if v > before.get(k, 0))
+
 
 def ai_refine_query(user_prompt: str, model_name: str | None = None) -> dict[str, Any]:
-    client = GeminiClient(model_name=model_name)
+    client = _get_client(model_name)
     out = client.generate_json(
         QUERY_USER_TEMPLATE.format(prompt=user_prompt),
         system_instruction=QUERY_SYSTEM,
@@ -39,13 +112,62 @@ def ai_refine_query(user_prompt: str, model_name: str | None = None) -> dict[str
     strategy.setdefault("context_after_chars", 120)
     return spec
 
-def run_query_on_text(full_text: str, spec: dict[str, Any]) -> list[dict[str, Any]]:
-    # Split by page anchors
-    segments = re.split(r"<<PAGE\s+(\d+)>>", full_text)
+def _keyword_hits_ahocorasick(
+    haystack: str,
+    keyword_list: list[str],
+    case_sensitive: bool,
+    page_starts: list[int],
+    page_spans: list[tuple[int, int, int]],
+) -> dict[int, list[tuple[int, str, int, int]]]:
+    """
+    One Aho-Corasick pass over the whole text. Returns {page_pos: [(kw_idx, kw, start, end)]}
+    with offsets local to the page, keeping re.finditer's non-overlapping semantics per keyword.
+    """
+    words: dict[str, list[tuple[int, str]]] = {}
+    for ki, kw in enumerate(keyword_list):
+        key = kw if case_sensitive else kw.lower()
+        if key:
+            words.setdefault(key, []).append((ki, kw))
+    hits: dict[int, list[tuple[int, str, int, int]]] = {}
+    if not words:
+        return hits
+
+    automaton = ahocorasick.Automaton()
+    for key, entries in words.items():
+        automaton.add_word(key, (len(key), entries))
+    automaton.make_automaton()
+
+    last_end: dict[int, int] = {}
+    for end_idx, (klen, entries) in automaton.iter(haystack):
+        start, end = end_idx - klen + 1, end_idx + 1
+        pos = bisect.bisect_right(page_starts, start) - 1
+        if pos < 0:
+            continue
+        _, p_start, p_end = page_spans[pos]
+        if end > p_end:
+            continue
+        for ki, kw in entries:
+            if start < last_end.get(ki, -1):
+                continue
+            last_end[ki] = end
+            hits.setdefault(pos, []).append((ki, kw, start - p_start, end - p_start))
+    return hits
+
+
+def run_query_on_text(
+    full_text: str,
+    spec: dict[str, Any],
+    page_index: dict[int, tuple[int, int]] | None = None,
+) -> list[dict[str, Any]]:
+    if page_index is None:
+        page_index = _page_index_for(full_text)
+    # (page, start, end) in text order
+    page_spans = sorted(((p, a, b) for p, (a, b) in page_index.items()), key=lambda x: x[1])
     results: list[dict[str, Any]] = []
 
     mode = spec["strategy"]["mode"]
-    case = 0 if spec["strategy"]["case_sensitive"] else re.IGNORECASE
+    case_sensitive = bool(spec["strategy"]["case_sensitive"])
+    case = 0 if case_sensitive else re.IGNORECASE
     before = int(spec["strategy"]["context_before_chars"])
     after = int(spec["strategy"]["context_after_chars"])
 
@@ -64,12 +186,17 @@ def run_query_on_text(full_text: str, spec: dict[str, Any]) -> list[dict[str, An
             row["term"] = term
         results.append(row)
 
-    for i in range(1, len(segments), 2):
-        try:
-            page = int(segments[i])
-        except Exception:
-            continue
-        text = segments[i + 1] if i + 1 < len(segments) else ""
+    ac_hits = None
+    if mode != "regex" and keyword_list and ahocorasick is not None:
+        haystack = full_text if case_sensitive else full_text.lower()
+        # lower() can change length for a few code points; offsets would drift, so use regex then
+        if len(haystack) == len(full_text):
+            page_starts = [a for _, a, _ in page_spans]
+            ac_hits = _keyword_hits_ahocorasick(haystack, keyword_list, case_sensitive, page_starts, page_spans)
+    kw_patterns = [] if ac_hits is not None else [(kw, re.compile(re.escape(kw), case)) for kw in keyword_list]
+
+    for pos, (page, p_start, p_end) in enumerate(page_spans):
+        text = full_text[p_start:p_end]
 
         if mode == "regex" and patterns:
             for rx in patterns:
@@ -79,14 +206,15 @@ def run_query_on_text(full_text: str, spec: dict[str, Any]) -> list[dict[str, An
             # keywords
             if not keyword_list:
                 continue
-            # Simple scan: find all occurrences of each keyword
-            hits = []
-            for kw in keyword_list:
-                # Find all case-insensitive occurrences
-                pos = 0
-                rx = re.compile(re.escape(kw), case)
-                for m in rx.finditer(text):
-                    hits.append((kw, m.start(), m.end()))
+            if ac_hits is not None:
+                # Same ordering as the per-keyword scan: keyword order, then position
+                hits = [(kw, s0, e0) for _, kw, s0, e0 in sorted(ac_hits.get(pos, []), key=lambda h: (h[0], h[2]))]
+            else:
+                # Simple scan: find all occurrences of each keyword
+                hits = []
+                for kw, rx in kw_patterns:
+                    for m in rx.finditer(text):
+                        hits.append((kw, m.start(), m.end()))
             if any_all == "all":
                 present = {kw for kw, _, _ in hits}
                 if not all(kw.lower() in {p.lower() for p in present} for kw in keyword_list):
@@ -110,43 +238,26 @@ def save_query_results(items: list[dict[str, Any]], json_path: str, csv_path: st
         w.writeheader()
         w.writerows(items)
 
-def parse_json_str(s: str) -> Any:
-    """
-    Parse JSON that may be wrapped in Markdown code fences.
-    Uses a balanced-brace/Bracket scan; no fragile backtick-anchored regex.
-    """
-    s = s.strip()
-    m = re.search(r"``````", s, flags=re.DOTALL)
-    candidate = m.group(1) if m else s
-
-    start = None
-    depth = 0
-    in_str = False
-    esc = False
-    for i, ch in enumerate(candidate):
-        if start is None:
-            if ch in "[{":
-                start = i
-                depth = 1
-        else:
-            if in_str:
-                if esc:
-                    esc = False
-                elif ch == "\\":
-                    esc = True
-                elif ch == '"':
-                    in_str = False
-            else:
-                if ch == '"':
-                    in_str = True
-                elif ch in "[{":
-                    depth += 1
-                elif ch in "]}":
-                    depth -= 1
-                    if depth == 0:
-                        fragment = candidate[start : i + 1]
-                        return json.loads(fragment)
-    return json.loads(candidate)
+def _as_page(value: Any, default: int) -> int:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float):
+        # the stdlib fallback in loads() accepts NaN/Infinity, which int() rejects
+        return int(value) if math.isfinite(value) else default
+    text = str(value).strip() if value is not None else ""
+    return int(text) if text.isdecimal() else default
+
+
+def _join_capped(parts: list[str], limit: int) -> str:
+    # Same as " ".join(parts)[:limit] without joining summaries past the cap
+    taken: list[str] = []
+    size = -1
+    for part in parts:
+        taken.append(part)
+        size += len(part) + 1
+        if size >= limit:
+            break
+    return " ".join(taken)[:limit]
 
 
 def _reconcile_sections(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
@@ -157,25 +268,15 @@ def _reconcile_sections(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
         title = str(it.get("title", "")).strip()
         if not title:
             continue
-        try:
-            sp = int(it.get("start_page", 1))
-        except Exception:
-            sp = 1
-        try:
-            ep = int(it.get("end_page", sp))
-        except Exception:
-            ep = sp
+        sp = max(1, _as_page(it.get("start_page"), 1))
+        ep = max(sp, _as_page(it.get("end_page"), sp))
         summary = str(it.get("summary", "")).strip()
-        key = re.sub(r"\s+", " ", title.lower())
-        sp = max(1, sp)
-        ep = max(sp, ep)
-        if key not in groups:
-            groups[key] = {"title": title, "start_page": sp, "end_page": ep, "summaries": [summary] if summary else []}
-        else:
-            groups[key]["start_page"] = min(groups[key]["start_page"], sp)
-            groups[key]["end_page"] = max(groups[key]["end_page"], ep)
-            if summary:
-                groups[key]["summaries"].append(summary)
+        key = " ".join(title.lower().split())
+        g = groups.setdefault(key, {"title": title, "start_page": sp, "end_page": ep, "summaries": []})
+        g["start_page"] = min(g["start_page"], sp)
+        g["end_page"] = max(g["end_page"], ep)
+        if summary:
+            g["summaries"].append(summary)
 
     merged: list[dict[str, Any]] = []
     for v in groups.values():
@@ -184,7 +285,7 @@ def _reconcile_sections(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
                 "title": v["title"],
                 "start_page": v["start_page"],
                 "end_page": v["end_page"],
-                "summary": " ".join(v["summaries"])[:1200],
+                "summary": _join_capped(v["summaries"], 1200),
             }
         )
 
@@ -202,66 +303,383 @@ def ai_segment_text(full_text: str, model_name: str | None = None) -> list[dict[
     """
     Segment using locally extracted text that includes <<PAGE N>> anchors.
     """
-    client = GeminiClient(model_name=model_name)
-    chunks = chunk_text_for_model(full_text)
+    client = _get_client(model_name)
+    groups = group_chunks(chunk_text_for_model(full_text), max_per_group=SEGMENT_CHUNKS_PER_CALL)
+    prompts = []
+    for group in groups:
+        if len(group) == 1:
+            prompt = SEGMENT_USER_TEMPLATE.format(chunk=group[0])
+        else:
+            prompt = SEGMENT_MULTI_USER_TEMPLATE.format(
+                count=len(group),
+                chunks="".join(f"\n\n---CHUNK {i}---\n{ch}" for i, ch in enumerate(group)),
+            )
+        prompts.append((prompt, SEGMENT_SYSTEM))
+    outputs = client.generate_json_batch(prompts, temperature=0.1, max_output_tokens=20000)
     collected: list[dict[str, Any]] = []
-    for ch in chunks:
-        prompt = SEGMENT_USER_TEMPLATE.format(chunk=ch)
-        out = client.generate_json(
-            prompt,
-            system_instruction=SEGMENT_SYSTEM,
-            temperature=0.1,
-            max_output_tokens=20000,
-        )
+    for out in outputs:
         try:
             arr = parse_json_str(out)
-            if isinstance(arr, dict):
-                arr = [arr]
-            for it in arr:
-                if isinstance(it, dict):
-                    collected.append(it)
         except Exception:
             continue
+        if isinstance(arr, dict):
+            arr = arr.get("chunks", [arr])
+        if not isinstance(arr, list):
+            continue
+        # Multi-chunk prompts answer with one inner array per chunk; flatten them
+        for it in arr:
+            if isinstance(it, dict):
+                collected.append(it)
+            elif isinstance(it, list):
+                collected.extend(x for x in it if isinstance(x, dict))
     return _reconcile_sections(collected)
 
 
-def slice_pages_text(full_text: str, start_page: int, end_page: int) -> str:
-    parts = re.split(r"<<PAGE\s+(\d+)>>", full_text)
-    chunks: list[str] = []
-    for i in range(1, len(parts), 2):
-        try:
-            pnum = int(parts[i])
-        except Exception:
-            continue
-        ptext = parts[i + 1] if i + 1 < len(parts) else ""
-        if start_page <= pnum <= end_page:
-            chunks.append(ptext.strip())
-    return "\n\n".join(chunks)
+def supports_file_upload(model_name: str | None = None) -> bool:
+    """True when the client can send the PDF itself (new SDK); the legacy path sends text only."""
+    return _get_client(model_name).mode == "new"
 
 
-def ai_analyse_stance(section_title: str, section_text: str, model_name: str | None = None) -> dict[str, Any]:
-    client = GeminiClient(model_name=model_name)
-    prompt = STANCE_USER_TEMPLATE.format(section_title=section_title, text=section_text[:200000])
-    out = client.generate_json(
-        prompt,
-        system_instruction=STANCE_SYSTEM,
-        temperature=0.2,
-        max_output_tokens=20000,
+def ai_segment_pdf(
+    pdf: str | bytes,
+    instruction: str = SEGMENT_FILE_INSTRUCTION,
+    model_name: str | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Segment by uploading the PDF itself (path or bytes) through the Gemini file API,
+    instead of sending the locally extracted text.
+    """
+    client = _get_client(model_name)
+    out = client.generate_json_with_file(pdf, instruction, temperature=0.1, max_output_tokens=20000)
+    try:
+        arr = parse_json_str(out)
+    except Exception:
+        return []
+    if isinstance(arr, dict):
+        arr = [arr]
+    return _reconcile_sections([it for it in arr if isinstance(it, dict)] if isinstance(arr, list) else [])
+
+
+def slice_pages_text(
+    full_text: str,
+    start_page: int,
+    end_page: int,
+    page_index: dict[int, tuple[int, int]] | None = None,
+) -> str:
+    """
+    Return the text of pages start_page..end_page (inclusive).
+    Pass the page_index from extract_text_pipeline to avoid rescanning full_text per call.
+    """
+    if page_index is None:
+        page_index = _page_index_for(full_text)
+    return "\n\n".join(
+        full_text[page_index[p][0] : page_index[p][1]].strip()
+        for p in range(start_page, end_page + 1)
+        if p in page_index
     )
+
+
+def _fit_token_budget(text: str, max_tokens: int | None = None) -> str:
+    """
+    Keep section text within a token budget (estimated as len // 4). Over budget, send the
+    first 40%, a centred 20% slice and the last 40% of the budget, since stance markers are
+    spread through a section rather than concentrated at its start.
+    """
+    max_tokens = STANCE_MAX_TOKENS if max_tokens is None else max_tokens
+    if len(text) // 4 <= max_tokens:
+        return text
+    budget = max_tokens * 4
+    head = int(budget * 0.4)
+    mid = budget - 2 * head
+    mid_start = (len(text) - mid) // 2
+    gap = "\n\n[...]\n\n"
+    return text[:head] + gap + text[mid_start : mid_start + mid] + gap + text[len(text) - head :]
+
+
+def _chunk_text(text: str, max_chars: int | None = None, overlap: int | None = None) -> list[str]:
+    """
+    Split a long section into windows of at most max_chars, cut at page anchors or paragraph
+    breaks, overlapping by `overlap` chars except at page anchors. Short texts stay whole.
+    """
+    max_chars = STANCE_CHUNK_CHARS if max_chars is None else max_chars
+    overlap = STANCE_CHUNK_OVERLAP if overlap is None else overlap
+    if len(text) <= max_chars:
+        return [text]
+    return chunk_text_for_model(text, target_chars=max_chars, overlap_chars=overlap)
+
+
+def _salient_text(text: str) -> str:
+    """
+    For sections over STANCE_SALIENCE_CHARS, keep only the text around CUE_RE matches
+    (STANCE_SALIENCE_CONTEXT chars either side, overlapping windows merged), joined with
+    gap markers. Stance markers are sparse in long sections, so most of the text is dropped.
+    """
+    if len(text) <= STANCE_SALIENCE_CHARS:
+        return text
+    ctx = STANCE_SALIENCE_CONTEXT
+    windows: list[list[int]] = []
+    for m in CUE_RE.finditer(text):
+        start, end = max(0, m.start() - ctx), min(len(text), m.end() + ctx)
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = end
+        else:
+            windows.append([start, end])
+    if not windows:
+        return text
+    return "\n… [gap] …\n".join(text[start:end] for start, end in windows)
+
+
+def _stance_chunks(text: str) -> list[str]:
+    # Cue windows first, then the token budget over the whole section, then chunking: the
+    # budget caps what one section sends in total, however many chunks it is split into
+    return _chunk_text(_fit_token_budget(_salient_text(text)))
+
+
+def _stance_prompt(section_title: str, text: str) -> str:
+    return STANCE_USER_TEMPLATE.format(section_title=section_title, text=text)
+
+
+def _empty_stance(section_title: str, summary: str) -> dict[str, Any]:
+    return {"section": section_title, **{cat: [] for cat in STANCE_CATEGORIES}, "summary": summary}
+
+
+def _needs_stance(section_title: str, text: str) -> bool:
+    """False for reference/appendix sections and text with fewer than STANCE_MIN_CUES cue words."""
+    if " ".join(section_title.lower().split()).strip(" .:") in STANCE_SKIP_TITLES:
+        return False
+    hits = 0
+    for _ in CUE_RE.finditer(text):
+        hits += 1
+        if hits >= STANCE_MIN_CUES:
+            return True
+    return False
+
+
+def _parse_stance(section_title: str, out: str) -> dict[str, Any]:
     try:
         data = parse_json_str(out)
-        for k in ["hedges", "boosters", "attitude_markers", "self_mentions"]:
+        for k in STANCE_CATEGORIES:
             if k not in data or not isinstance(data[k], list):
                 data[k] = []
         data.setdefault("section", section_title)
         data.setdefault("summary", "")
         return data
     except Exception:
-        return {
-            "section": section_title,
-            "hedges": [],
-            "boosters": [],
-            "attitude_markers": [],
-            "self_mentions": [],
-            "summary": "Parsing failed",
-        }
+        # Flagged so the merge and the memo can tell a failed chunk from one with no markers
+        return {**_empty_stance(section_title, "Parsing failed"), "parse_failed": True}
+
+
+def _merge_stance(section_title: str, parts: list[dict[str, Any]]) -> dict[str, Any]:
+    """
+    Merge per-chunk results of one section; examples repeated in the overlaps count once.
+    If any chunk failed to parse, the merged result keeps parse_failed so it is not memoised.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    failed = any(p.get("parse_failed") for p in parts)
+    parts = [p for p in parts if not p.get("parse_failed")]
+    if not parts:
+        return {**_empty_stance(section_title, "Parsing failed"), "parse_failed": True}
+    merged: dict[str, Any] = {"section": section_title}
+    for cat in STANCE_CATEGORIES:
+        seen = set()
+        examples = []
+        for part in parts:
+            for ex in part[cat]:
+                key = (ex.get("word"), ex.get("sentence")) if isinstance(ex, dict) else ex
+                try:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                except TypeError:  # unhashable example shape, keep it as is
+                    pass
+                examples.append(ex)
+        merged[cat] = examples
+    merged["summary"] = _join_capped([p["summary"] for p in parts if p.get("summary")], 1200)
+    if failed:
+        merged["parse_failed"] = True
+    return merged
+
+
+def _analyse_stance_chunk(
+    client: GeminiClient, section_title: str, text: str, limit: threading.Semaphore | None = None
+) -> dict[str, Any]:
+    with limit or nullcontext():
+        out = client.generate_json(
+            _stance_prompt(section_title, text),
+            system_instruction=STANCE_SYSTEM,
+            temperature=0.2,
+            max_output_tokens=20000,
+        )
+    return _parse_stance(section_title, out)
+
+
+# In-process LRU of finished stance results, keyed by _stance_key. Re-runs with other settings
+# (e.g. toggling "conclusion only") then only analyse sections they have not seen yet.
+_stance_memo: OrderedDict[str, dict[str, Any]] = OrderedDict()
+_stance_memo_lock = threading.Lock()
+
+
+def _stance_key(section_title: str, section_text: str, model_name: str | None) -> str:
+    h = hashlib.sha1()
+    for part in (model_name or "", section_title, section_text):
+        h.update(part.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _memo_get(key: str) -> dict[str, Any] | None:
+    with _stance_memo_lock:
+        res = _stance_memo.get(key)
+        if res is not None:
+            _stance_memo.move_to_end(key)
+        return res
+
+
+def _memo_put(key: str, res: dict[str, Any]):
+    if res.get("parse_failed"):
+        return
+    with _stance_memo_lock:
+        _stance_memo[key] = res
+        _stance_memo.move_to_end(key)
+        while len(_stance_memo) > STANCE_MEMO_SIZE:
+            _stance_memo.popitem(last=False)
+
+
+def ai_analyse_stance(
+    section_title: str,
+    section_text: str,
+    model_name: str | None = None,
+    limit: threading.Semaphore | None = None,
+) -> dict[str, Any]:
+    """
+    Stance analysis for one section. Sections longer than STANCE_CHUNK_CHARS are analysed
+    chunk by chunk, concurrently, and the per-category arrays merged. Results are memoised
+    in-process by content hash (STANCE_MEMO_SIZE entries). If given, `limit` is held around
+    every Gemini request, so one semaphore can cap requests in flight across many sections.
+    """
+    key = _stance_key(section_title, section_text, model_name)
+    res = _memo_get(key)
+    if res is None:
+        res = _analyse_stance_uncached(section_title, section_text, model_name, limit)
+        _memo_put(key, res)
+    return res
+
+
+def _analyse_stance_uncached(
+    section_title: str, section_text: str, model_name: str | None, limit: threading.Semaphore | None
+) -> dict[str, Any]:
+    if not _needs_stance(section_title, section_text):
+        return _empty_stance(section_title, "Skipped by stance prefilter")
+    client = _get_client(model_name)
+    chunks = _stance_chunks(section_text)
+    if len(chunks) == 1:
+        return _analyse_stance_chunk(client, section_title, chunks[0], limit)
+    # A private pool: waiting on chunks submitted to the callers' section pool could deadlock it.
+    # The requests themselves are still capped by `limit`, which callers share across sections.
+    with ThreadPoolExecutor(max_workers=min(len(chunks), max(1, STANCE_CONCURRENCY))) as executor:
+        parts = list(executor.map(lambda ch: _analyse_stance_chunk(client, section_title, ch, limit), chunks))
+    return _merge_stance(section_title, parts)
+
+
+def ai_analyse_stance_batch(sections: list[tuple[str, str]], model_name: str | None = None) -> list[dict[str, Any]]:
+    """
+    Stance analysis for many (title, text) sections submitted as one Gemini batch.
+    Long sections contribute one request per chunk; memoised sections are not resubmitted.
+    Results are returned in input order.
+    """
+    keys = [_stance_key(title, text, model_name) for title, text in sections]
+    results = [_memo_get(key) for key in keys]
+    pending = [i for i, res in enumerate(results) if res is None]
+    if not pending:
+        return results
+
+    client = _get_client(model_name)
+    chunked = [
+        (sections[i][0], _stance_chunks(sections[i][1]) if _needs_stance(*sections[i]) else [])
+        for i in pending
+    ]
+    outputs = iter(
+        client.generate_json_batch(
+            [(_stance_prompt(title, ch), STANCE_SYSTEM) for title, chunks in chunked for ch in chunks],
+            temperature=0.2,
+            max_output_tokens=20000,
+        )
+    )
+    for i, (title, chunks) in zip(pending, chunked):
+        if chunks:
+            results[i] = _merge_stance(title, [_parse_stance(title, next(outputs)) for _ in chunks])
+        else:
+            results[i] = _empty_stance(title, "Skipped by stance prefilter")
+        _memo_put(keys[i], results[i])
+    return results
+
+
+def _length_bins(sections: list[tuple[str, str]]) -> list[list[int]]:
+    """
+    Split section indices into short / medium / long bins at the text-length terciles, so each
+    wave of concurrent calls holds sections of similar size and one long section does not
+    hold up many short ones.
+    """
+    lengths = [len(text) for _, text in sections]
+    if len(lengths) < 3:
+        return [list(range(len(lengths))), [], []]
+    low, high = statistics.quantiles(lengths, n=3)
+    bins: list[list[int]] = [[], [], []]
+    for idx, n in enumerate(lengths):
+        bins[0 if n <= low else 1 if n <= high else 2].append(idx)
+    return bins
+
+
+def iter_stance_results(
+    sections: list[tuple[str, str]],
+    model_name: str | None = None,
+    max_workers: int | None = None,
+) -> Iterator[tuple[int, dict[str, Any]]]:
+    """
+    Yield (index, result) for each (title, text) section as soon as its analysis finishes,
+    so callers can render partial results. Order follows completion, not input; in Batch Mode
+    everything arrives at once when the job is done. Otherwise sections run bin by bin (see
+    _length_bins), shortest first, with the full worker budget for short bins and less for long ones.
+    """
+    if not sections:
+        return
+    if BATCH_MODE:
+        yield from enumerate(ai_analyse_stance_batch(sections, model_name=model_name))
+        return
+
+    workers = max(1, max_workers or STANCE_CONCURRENCY)
+    # Chunked sections fan out further; the semaphore keeps requests in flight at `workers`
+    limit = threading.Semaphore(workers)
+    for scale, bin_idx in zip(STANCE_BIN_SCALE, _length_bins(sections)):
+        if not bin_idx:
+            continue
+        with ThreadPoolExecutor(max_workers=min(workers, max(1, int(workers * scale)))) as executor:
+            futures = {
+                executor.submit(ai_analyse_stance, *sections[idx], model_name=model_name, limit=limit): idx
+                for idx in bin_idx
+            }
+            for fut in as_completed(futures):
+                yield futures[fut], fut.result()
+
+
+def iter_stance_ordered(
+    sections: list[tuple[str, str]],
+    model_name: str | None = None,
+    max_workers: int | None = None,
+    progress_cb=None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Like iter_stance_results, but yields bare results in input order: each one as soon as it
+    and every section before it have finished. progress_cb(done, total) fires per completion.
+    """
+    pending: dict[int, dict[str, Any]] = {}
+    next_idx = 0
+    # the generator runs on the calling thread, so the counter needs no lock
+    for done, (idx, res) in enumerate(iter_stance_results(sections, model_name, max_workers), start=1):
+        pending[idx] = res
+        if progress_cb:
+            progress_cb(done, len(sections))
+        while next_idx in pending:
+            yield pending.pop(next_idx)
+            next_idx += 1
@@ -1,26 +1,158 @@
 import orjson
 import csv
+import json
 from pathlib import Path
+from typing import Any
+
+try:
+    from numba import njit  # optional: compiles the JSON span scan to native code
+except ImportError:
+    njit = None
+
+def dumps(data) -> bytes:
+    """Indented JSON as UTF-8 bytes, ready for a file or st.download_button."""
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+def loads(data: str | bytes):
+    # orjson takes str or bytes without an extra decode; stdlib covers what orjson rejects
+    # (lone surrogates, NaN/Infinity literals)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+def _scan_json_span(buf: bytes) -> tuple[int, int]:
+    """
+    Byte offsets [start, end) of the first balanced JSON object/array in buf, or (-1, -1).
+    Works on UTF-8 bytes (all structural characters are ASCII) so Numba can compile it.
+    """
+    start = -1
+    depth = 0
+    in_str = False
+    esc = False
+    for i in range(len(buf)):
+        c = buf[i]
+        if start < 0:
+            if c == 91 or c == 123:  # [ {
+                start = i
+                depth = 1
+        elif in_str:
+            if esc:
+                esc = False
+            elif c == 92:  # backslash
+                esc = True
+            elif c == 34:  # "
+                in_str = False
+        elif c == 34:
+            in_str = True
+        elif c == 91 or c == 123:
+            depth += 1
+        elif c == 93 or c == 125:  # ] }
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    return -1, -1
+
+_find_json_span = njit(cache=True)(_scan_json_span) if njit is not None else None
+
+def extract_json_block(s: str) -> str:
+    """
+    The first balanced JSON object/array in s, found in one pass that skips brackets inside
+    string literals; s unchanged if there is none. Uses the Numba-compiled scan when available.
+    """
+    if _find_json_span is not None:
+        buf = s.encode("utf-8")
+        start, end = _find_json_span(buf)
+        return buf[start:end].decode("utf-8") if start >= 0 else s
+
+    start = None
+    depth = 0
+    in_str = False
+    esc = False
+    for i, ch in enumerate(s):
+        if start is None:
+            if ch in "[{":
+                start = i
+                depth = 1
+        else:
+            if in_str:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            else:
+                if ch == '"':
+                    in_str = True
+                elif ch in "[{":
+                    depth += 1
+                elif ch in "]}":
+                    depth -= 1
+                    if depth == 0:
+                        return s[start : i + 1]
+    return s
+
+def parse_json_str(s: str) -> Any:
+    """
+    Parse JSON that may be wrapped in Markdown code fences.
+    Fence-stripped text goes straight to orjson; extract_json_block is only the
+    fallback for responses with prose around the JSON.
+    """
+    candidate = s.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    try:
+        return orjson.loads(candidate)
+    except orjson.JSONDecodeError:
+        pass
+    return loads(extract_json_block(candidate))
 
 def save_json(data, path: str):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
     with open(path, "wb") as f:
-        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        if not isinstance(data, list) or not data:
+            f.write(dumps(data))
+            return
+        # Top-level lists are written item by item; output is byte-identical to
+        # orjson.dumps(data, OPT_INDENT_2) without materialising the whole buffer.
+        f.write(b"[\n  ")
+        for i, item in enumerate(data):
+            if i:
+                f.write(b",\n  ")
+            f.write(dumps(item).replace(b"\n", b"\n  "))
+        f.write(b"\n]")
 
-def save_csv_stance(items, path: str):
-    rows = []
+def save_jsonl(items, path: str):
+    """One compact JSON object per line; items may be any iterable."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        for item in items:
+            f.write(orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE))
+
+STANCE_CATEGORIES = ["hedges", "boosters", "attitude_markers", "self_mentions"]
+STANCE_CSV_FIELDS = ["section", "category", "word", "sentence"]
+
+def _stance_rows(item):
+    section = item.get("section", "")
+    for cat in STANCE_CATEGORIES:
+        for ex in item.get(cat, []):
+            yield (section, cat, ex.get("word", ""), ex.get("sentence", ""))
+
+def write_csv_stance_item(w, item):
+    """Append one section's rows to a csv.writer whose header row is already written."""
+    w.writerows(_stance_rows(item))
+
+def write_csv_stance(f, items):
+    """
+    Write stance CSV rows to an open text file or buffer (e.g. io.StringIO).
+    items may be a generator: each section's rows are written and flushed as it arrives.
+    """
+    w = csv.writer(f)
+    w.writerow(STANCE_CSV_FIELDS)
     for item in items:
-        section = item.get("section", "")
-        for cat in ["hedges", "boosters", "attitude_markers", "self_mentions"]:
-            for ex in item.get(cat, []):
-                rows.append({
-                    "section": section,
-                    "category": cat,
-                    "word": ex.get("word", ""),
-                    "sentence": ex.get("sentence", ""),
-                })
+        write_csv_stance_item(w, item)
+        f.flush()
+
+def save_csv_stance(items, path: str):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
     with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=["section", "category", "word", "sentence"])
-        w.writeheader()
-        w.writerows(rows)
+        write_csv_stance(f, items)
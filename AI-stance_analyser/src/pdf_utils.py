@@ -1,65 +1,217 @@
 from dataclasses import dataclass
-from typing import List, Tuple, Dict
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple, Union
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
+import os
+import random
 import re
 import fitz  # PyMuPDF
 
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_EXTRACT_CHUNK_SIZE = max(1, int(os.getenv("PDF_EXTRACT_CHUNK_SIZE", "16")))
+# Below this page count, worker start-up costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+HEADER_SAMPLE_PAGES = int(os.getenv("HEADER_SAMPLE_PAGES", "500"))
+PDF_DIGITAL_THRESHOLD = int(os.getenv("PDF_DIGITAL_THRESHOLD", "200"))
+
+try:
+    import xxhash  # faster than Python string hashing for line keys
+except ImportError:
+    xxhash = None
+
+def _line_hash(line: str) -> int:
+    return xxhash.xxh64_intdigest(line.encode("utf-8")) if xxhash is not None else hash(line)
+
+_PAGE_ANCHOR_RE = re.compile(r"<<PAGE\s+(\d+)>>")
+# Line-level alternatives for remove_headers_footers_and_numbers (MULTILINE)
+_BLANK_LINE = r"[^\S\n]*(?:\n|\Z)"
+_PAGE_NUM_LINE = r"[^\S\n]*(?:\d+|[ivxlcdm]+)[^\S\n]*(?:\n|\Z)"
+_DROP_LINES_RE = re.compile(f"^(?:{_BLANK_LINE}|{_PAGE_NUM_LINE})", re.MULTILINE | re.IGNORECASE)
+
+PdfSource = Union[str, os.PathLike, bytes, bytearray, BinaryIO]
+
 @dataclass
 class PageText:
     page_num: int  # 1-based
     text: str
 
-def extract_text_from_pdf(path: str, header_clip_height: int = 50, footer_clip_height: int = 50) -> List[PageText]:
-    doc = fitz.open(path)
-    pages = []
-    for i, page in enumerate(doc):
-        rect = page.rect
-        clip = fitz.Rect(0, header_clip_height, rect.width, rect.height - footer_clip_height)
-        text = page.get_text(clip=clip)
-        pages.append(PageText(page_num=i + 1, text=text))
-    doc.close()
-    return pages
-
-def detect_repeated_headers_footers(pages: List[PageText], top_n_lines: int = 2, bottom_n_lines: int = 2) -> Dict[str, str]:
-    from collections import Counter
-    top_counter, bot_counter = Counter(), Counter()
+def _clipped_page_text(page, header_clip_height: int, footer_clip_height: int) -> str:
+    rect = page.rect
+    clip = fitz.Rect(0, header_clip_height, rect.width, rect.height - footer_clip_height)
+    return page.get_text(clip=clip)
+
+def _normalize_source(source: PdfSource) -> Union[str, bytes]:
+    """Paths stay paths; in-memory PDFs (bytes or binary file objects) become bytes."""
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    return source.read()
+
+def _open_pdf(source: Union[str, bytes]):
+    if isinstance(source, bytes):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+def detect_extraction_mode(source: PdfSource, sample_pages: int = 9) -> str:
+    """
+    "digital" when the PDF carries a text layer, otherwise "scanned": local extraction would
+    yield (almost) no text, so callers should let Gemini read the PDF itself. Decided on the
+    median character count of up to sample_pages pages spread over the whole document
+    (against PDF_DIGITAL_THRESHOLD), so a cover, blank or copyright page does not tip it.
+    """
+    with _open_pdf(_normalize_source(source)) as doc:
+        n = doc.page_count
+        if n == 0:
+            return "scanned"
+        k = min(sample_pages, n)
+        picks = sorted({(i * n) // k for i in range(k)})
+        counts = sorted(len(doc[i].get_text().strip()) for i in picks)
+    return "digital" if counts[len(counts) // 2] > PDF_DIGITAL_THRESHOLD else "scanned"
+
+# Per-process document handle for the extraction workers, opened once by _init_extract_worker
+_worker_doc = None
+
+def _init_extract_worker(source: Union[str, bytes]):
+    global _worker_doc
+    _worker_doc = _open_pdf(source)
+
+def _extract_page_range(start: int, stop: int, header_clip_height: int, footer_clip_height: int) -> List[str]:
+    return [_clipped_page_text(_worker_doc[i], header_clip_height, footer_clip_height) for i in range(start, stop)]
+
+def iter_pages(source: PdfSource, header_clip_height: int = 50, footer_clip_height: int = 50) -> Iterator[PageText]:
+    """
+    Yield pages in order as their text is extracted. source is a path, bytes or a binary file object.
+    Documents of PDF_PARALLEL_MIN_PAGES pages or more are extracted on a process pool
+    (PDF_EXTRACT_WORKERS processes, PDF_EXTRACT_CHUNK_SIZE pages per task): MuPDF holds
+    the GIL while extracting, so threads would not run in parallel.
+    """
+    source = _normalize_source(source)
+    with _open_pdf(source) as doc:
+        page_count = doc.page_count
+        workers = min(PDF_EXTRACT_WORKERS, -(-page_count // PDF_EXTRACT_CHUNK_SIZE))
+        if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            for i, page in enumerate(doc):
+                yield PageText(page_num=i + 1, text=_clipped_page_text(page, header_clip_height, footer_clip_height))
+            return
+
+    starts = range(0, page_count, PDF_EXTRACT_CHUNK_SIZE)
+    stops = [min(start + PDF_EXTRACT_CHUNK_SIZE, page_count) for start in starts]
+    # The source is shipped once per worker process, not once per page range. Workers are
+    # never forked from the caller: Streamlit and the Tk worker thread make it multi-threaded,
+    # and a child forked while another thread holds a lock can deadlock.
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(method),
+        initializer=_init_extract_worker,
+        initargs=(source,),
+    ) as ex:
+        ranges = ex.map(
+            _extract_page_range,
+            starts,
+            stops,
+            [header_clip_height] * len(stops),
+            [footer_clip_height] * len(stops),
+        )
+        for start, texts in zip(starts, ranges):
+            for offset, text in enumerate(texts):
+                yield PageText(page_num=start + offset + 1, text=text)
+
+def extract_text_from_pdf(source: PdfSource, header_clip_height: int = 50, footer_clip_height: int = 50) -> List[PageText]:
+    return list(iter_pages(source, header_clip_height, footer_clip_height))
+
+def detect_repeated_headers_footers(pages: Iterable[PageText], top_n_lines: int = 2, bottom_n_lines: int = 2, sample_size: int = HEADER_SAMPLE_PAGES) -> Dict[str, str]:
+    # Reservoir-sample (top, bottom) line hashes so very long documents are only partly counted;
+    # documents up to sample_size pages are counted in full, in page order.
+    rng = random.Random(0)
+    sample: List[Tuple[int | None, int | None]] = []
+    top_repr: Dict[int, str] = {}
+    bot_repr: Dict[int, str] = {}
+    seen = 0
     for p in pages:
         lines = [ln.strip() for ln in p.text.splitlines() if ln.strip()]
         if not lines:
             continue
+        seen += 1
+        if len(sample) < sample_size:
+            slot = len(sample)
+            sample.append((None, None))
+        else:
+            slot = rng.randrange(seen)
+            if slot >= sample_size:
+                continue
         top = " ".join(lines[:top_n_lines])
         bot = " ".join(lines[-bottom_n_lines:]) if len(lines) >= bottom_n_lines else ""
-        if top: top_counter[top] += 1
-        if bot: bot_counter[bot] += 1
-    header_candidate = next(iter(top_counter.most_common(1)), ("", 0))[0]
-    footer_candidate = next(iter(bot_counter.most_common(1)), ("", 0))[0]
+        th = _line_hash(top) if top else None
+        bh = _line_hash(bot) if bot else None
+        sample[slot] = (th, bh)
+        if th is not None:
+            top_repr.setdefault(th, top)
+        if bh is not None:
+            bot_repr.setdefault(bh, bot)
+
+    top_counter: Dict[int, int] = defaultdict(int)
+    bot_counter: Dict[int, int] = defaultdict(int)
+    for th, bh in sample:
+        if th is not None: top_counter[th] += 1
+        if bh is not None: bot_counter[bh] += 1
+    header_candidate = top_repr[max(top_counter, key=top_counter.get)] if top_counter else ""
+    footer_candidate = bot_repr[max(bot_counter, key=bot_counter.get)] if bot_counter else ""
     return {"header": re.escape(header_candidate) if header_candidate else "", "footer": re.escape(footer_candidate) if footer_candidate else ""}
 
-def remove_headers_footers_and_numbers(pages: List[PageText], patterns: Dict[str, str]) -> List[PageText]:
-    cleaned = []
-    header_re = re.compile(patterns.get("header", ""), re.IGNORECASE) if patterns.get("header") else None
-    footer_re = re.compile(patterns.get("footer", ""), re.IGNORECASE) if patterns.get("footer") else None
-    page_num_re = re.compile(r"^\s*(\d+|[ivxlcdmIVXLCDM]+)\s*$")
+def remove_headers_footers_and_numbers(pages: Iterable[PageText], patterns: Dict[str, str]) -> Iterator[PageText]:
+    # One multiline pattern per document drops, in a single C-level pass per page:
+    # blank lines, lines containing the header/footer, and bare page numbers.
+    alternatives = [_BLANK_LINE, _PAGE_NUM_LINE]
+    for key in ("header", "footer"):
+        if patterns.get(key):
+            alternatives.append(rf".*(?:{patterns[key]}).*(?:\n|\Z)")
+    if len(alternatives) == 2:
+        drop_re = _DROP_LINES_RE
+    else:
+        drop_re = re.compile("^(?:" + "|".join(alternatives) + ")", re.MULTILINE | re.IGNORECASE)
     for p in pages:
-        new_lines = []
-        for ln in p.text.splitlines():
-            s = ln.strip()
-            if not s:
-                continue
-            if header_re and header_re.search(s):
-                continue
-            if footer_re and footer_re.search(s):
-                continue
-            if page_num_re.match(s):
-                continue
-            new_lines.append(ln)
-        cleaned.append(PageText(page_num=p.page_num, text="\n".join(new_lines)))
-    return cleaned
+        yield PageText(page_num=p.page_num, text=drop_re.sub("", p.text).rstrip("\n"))
 
-def combine_pages(pages: List[PageText]) -> str:
-    parts = []
+def combine_pages_indexed(pages: Iterable[PageText]) -> Tuple[str, Dict[int, Tuple[int, int]]]:
+    """
+    Join pages with <<PAGE N>> anchors and record, per page number, the (start, end)
+    offsets of that page's text inside the combined string.
+    """
+    buf = io.StringIO()
+    page_index: Dict[int, Tuple[int, int]] = {}
+    offset = 0
     for p in pages:
-        parts.append(f"<<PAGE {p.page_num}>>\n{p.text}")
-    return "\n\n".join(parts)
+        if offset:
+            buf.write("\n\n")
+            offset += 2
+        num = str(p.page_num)
+        buf.write("<<PAGE ")
+        buf.write(num)
+        buf.write(">>\n")
+        offset += len(num) + 10  # "<<PAGE " + ">>\n"
+        buf.write(p.text)
+        page_index[p.page_num] = (offset, offset + len(p.text))
+        offset += len(p.text)
+    return buf.getvalue(), page_index
+
+def combine_pages(pages: Iterable[PageText]) -> str:
+    return combine_pages_indexed(pages)[0]
+
+def build_page_index(text: str) -> Dict[int, Tuple[int, int]]:
+    """Recover the page index from already-combined text (one regex pass)."""
+    page_index: Dict[int, Tuple[int, int]] = {}
+    prev = None
+    for m in _PAGE_ANCHOR_RE.finditer(text):
+        if prev is not None:
+            page_index[prev[0]] = (prev[1], m.start())
+        prev = (int(m.group(1)), m.end())
+    if prev is not None:
+        page_index[prev[0]] = (prev[1], len(text))
+    return page_index
 
 def chunk_text_for_model(text: str, target_chars: int = 24000, overlap_chars: int = 1200):
     chunks = []
@@ -67,19 +219,50 @@ def chunk_text_for_model(text: str, target_chars: int = 24000, overlap_chars: in
     n = len(text)
     while start < n:
         end = min(start + target_chars, n)
-        boundary = text.rfind("\n\n", start, end)
-        if boundary == -1 or boundary <= start + int(0.3 * target_chars):
+        min_boundary = start + int(0.3 * target_chars)
+        # Prefer cutting right before a page anchor: pages are self-describing, so the
+        # next chunk can start there with no overlap. Otherwise fall back to a paragraph break.
+        boundary = text.rfind("\n\n<<PAGE ", start, end)
+        if boundary <= min_boundary:
+            boundary = text.rfind("\n\n", start, end)
+        if boundary == -1 or boundary <= min_boundary:
             boundary = end
         chunk = text[start:boundary]
         chunks.append(chunk)
         if boundary == n:
             break
-        start = max(0, boundary - overlap_chars)
+        if text.startswith("\n\n<<PAGE ", boundary):
+            start = boundary
+        else:
+            start = max(0, boundary - overlap_chars)
     return chunks
 
-def extract_text_pipeline(pdf_path: str) -> Tuple[List[PageText], List[PageText], str]:
-    raw_pages = extract_text_from_pdf(pdf_path)
+def group_chunks(chunks: List[str], max_chars: int = 180000, max_per_group: int = 4) -> List[List[str]]:
+    """Pack consecutive chunks into groups sent as one model call, capped by count and input size."""
+    groups: List[List[str]] = []
+    size = 0
+    for ch in chunks:
+        if groups and len(groups[-1]) < max_per_group and size + len(ch) <= max_chars:
+            groups[-1].append(ch)
+            size += len(ch)
+        else:
+            groups.append([ch])
+            size = len(ch)
+    return groups
+
+def _drain(items: List[PageText]) -> Iterator[PageText]:
+    # Yield items while clearing their list slots, so each page can be freed once consumed
+    for i in range(len(items)):
+        item, items[i] = items[i], None
+        yield item
+
+def extract_text_pipeline(source: PdfSource) -> Tuple[str, Dict[int, Tuple[int, int]]]:
+    """
+    Extract, clean and anchor a PDF given as a path, bytes or binary file object
+    (e.g. io.BytesIO). Returns (combined_text, page_index).
+    Raw page text is kept once for the header/footer pass, then released page by page as
+    cleaned pages are streamed into the combined buffer, so the two never both peak.
+    """
+    raw_pages = extract_text_from_pdf(source)
     patterns = detect_repeated_headers_footers(raw_pages)
-    cleaned_pages = remove_headers_footers_and_numbers(raw_pages, patterns)
-    combined_text = combine_pages(cleaned_pages)
-    return raw_pages, cleaned_pages, combined_text
+    return combine_pages_indexed(remove_headers_footers_and_numbers(_drain(raw_pages), patterns))
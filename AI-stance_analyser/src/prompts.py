@@ -41,12 +41,25 @@ Text:
 {chunk}
 """
 
+SEGMENT_MULTI_USER_TEMPLATE = """Input text includes page markers like <<PAGE N>> to help infer page ranges.
+It is split into {count} consecutive chunks, each introduced by a ---CHUNK i--- line (i starts at 0).
+Task:
+- Infer section boundaries for every chunk and map them to inclusive page ranges.
+- If overlaps occur across chunks, choose the most plausible boundary and keep consistency.
+- Return a JSON array with one inner array per chunk, in chunk order: [[...chunk 0 items...], [...chunk 1 items...], ...].
+
+Text:
+{chunks}
+"""
+
 STANCE_SYSTEM = """You are an academic discourse analyst applying Hyland’s stance model (2005).
 Classify stance resources into four categories with examples, counts, and short comments.
 Return only JSON with keys: section, hedges, boosters, attitude_markers, self_mentions, summary.
 Each category is an array of objects: {word, sentence}.
 """
 
+# Static guidance first, per-section values last: every stance request then shares the
+# STANCE_SYSTEM + guidance prefix, which Gemini's implicit context cache can reuse.
 STANCE_USER_TEMPLATE = """Analyse the following text according to Hyland’s stance model (2005):
 - Hedges (e.g., may, might, possible)
 - Boosters (e.g., clearly, definitely)
@@ -54,9 +67,11 @@ STANCE_USER_TEMPLATE = """Analyse the following text according to Hyland’s sta
 - Self-mentions (e.g., I, we, the researcher)
 
 Provide examples, counts (implicit by array length), and a short functional summary.
-Section label: {section_title}
 
-Text:
+---
+SECTION: {section_title}
+---
+TEXT:
 {text}
 """
 
@@ -1,40 +1,141 @@
+import csv
+import hashlib
+import io
 import streamlit as st
-import tempfile
-from pdf_utils import extract_text_pipeline
-from analysis import ai_segment_text, slice_pages_text, ai_analyse_stance
-from io_utils import save_json, save_csv_stance
+from src.pdf_utils import detect_extraction_mode, extract_text_pipeline
+from src.analysis import STANCE_CONCURRENCY, ai_segment_pdf, ai_segment_text, slice_pages_text, iter_stance_results, retry_stats, retry_stats_since, supports_file_upload
+from src.io_utils import STANCE_CSV_FIELDS, dumps, write_csv_stance_item
+
+
+@st.cache_data(show_spinner=False)
+def _cached_extract(pdf_bytes: bytes):
+    # Keyed on the file content, so reruns and re-uploads of the same PDF skip extraction
+    return extract_text_pipeline(pdf_bytes)
+
+
+@st.cache_data(show_spinner=False)
+def _cached_mode(pdf_bytes: bytes):
+    return detect_extraction_mode(pdf_bytes)
+
+
+class EmptySegmentation(Exception):
+    pass
+
+
+# Empty results raise instead of returning []: st.cache_data does not store exceptions,
+# so a failed or unparsable segmentation can be retried on the next run
+@st.cache_data(show_spinner=False)
+def _cached_segment(combined: str, model_name: str):
+    segmentation = ai_segment_text(combined, model_name=model_name)
+    if not segmentation:
+        raise EmptySegmentation()
+    return segmentation
+
+
+@st.cache_data(show_spinner=False)
+def _cached_segment_pdf(pdf_bytes: bytes, model_name: str):
+    segmentation = ai_segment_pdf(pdf_bytes, model_name=model_name)
+    if not segmentation:
+        raise EmptySegmentation()
+    return segmentation
+
 
 st.title("Thesis Sectioning + Hyland Stance Analysis")
 
 uploaded = st.file_uploader("Upload PhD thesis PDF", type=["pdf"])
 model = st.text_input("Gemini model name", value="gemini-2.0-flash")
 conclusion_only = st.checkbox("Analyse only General Conclusion")
+use_file_upload = st.checkbox("Segment via PDF upload", value=True)
+concurrency = st.slider("Concurrent stance requests", min_value=1, max_value=16, value=min(max(STANCE_CONCURRENCY, 1), 16))
 
-if uploaded and st.button("Run"):
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-        tmp.write(uploaded.read())
-        tmp_path = tmp.name
+RESULT_KEYS = ("segmentation", "stance_results", "stance_csv", "results_pdf_hash")
 
-    raw_pages, cleaned_pages, combined = extract_text_pipeline(tmp_path)
-    st.success("Extracted and cleaned text.")
+# Stored results belong to the PDF they were computed from; drop them once it is replaced or removed
+upload_hash = hashlib.sha1(uploaded.getvalue()).hexdigest() if uploaded else None
+if st.session_state.get("results_pdf_hash") != upload_hash:
+    for key in RESULT_KEYS:
+        st.session_state.pop(key, None)
 
-    segmentation = ai_segment_text(combined, model_name=model)
+if uploaded and st.button("Run"):
+    pdf_bytes = uploaded.getvalue()
+    stats_before = retry_stats(model)
+    mode = _cached_mode(pdf_bytes)
+    st.info(f"Extraction mode: {mode}")
+    if not supports_file_upload(model):
+        if use_file_upload:
+            st.warning("PDF upload needs the google-genai client (USE_NEW_GENAI=1); segmenting extracted text instead.")
+        use_file_upload = False
+    elif mode == "scanned" and not use_file_upload:
+        st.warning("No text layer found; segmenting via PDF upload instead.")
+        use_file_upload = True
+    try:
+        if use_file_upload:
+            # Gemini reads the PDF directly; local text is only extracted if stance needs it
+            segmentation = _cached_segment_pdf(pdf_bytes, model)
+        else:
+            combined, page_index = _cached_extract(pdf_bytes)
+            st.success("Extracted and cleaned text.")
+            segmentation = _cached_segment(combined, model)
+    except EmptySegmentation:
+        st.error("Segmentation returned no sections. Press Run to try again.")
+        st.stop()
     st.json(segmentation)
 
-    stance_results = []
-    for seg in segmentation:
-        title = seg["title"]
-        if conclusion_only and "conclusion" not in title.lower():
-            continue
-        text = slice_pages_text(combined, seg["start_page"], seg["end_page"])
-        res = ai_analyse_stance(title, text, model_name=model)
-        stance_results.append(res)
-
+    targets = [seg for seg in segmentation if not conclusion_only or "conclusion" in seg["title"].lower()]
+    if targets and use_file_upload:
+        combined, page_index = _cached_extract(pdf_bytes)
+        st.success("Extracted and cleaned text.")
+    sections = [
+        (seg["title"], slice_pages_text(combined, seg["start_page"], seg["end_page"], page_index))
+        for seg in targets
+    ]
+    st.subheader("Stance Results")
+    progress = st.progress(0.0)
+    placeholder = st.empty()
+    slots = [None] * len(sections)
+    csv_buf = io.StringIO()
+    csv_writer = csv.writer(csv_buf)
+    csv_writer.writerow(STANCE_CSV_FIELDS)
+    next_row = 0
+    # Re-render as each section finishes, keeping document order for the ones done so far;
+    # CSV rows are appended once every earlier section is in
+    for done, (idx, res) in enumerate(iter_stance_results(sections, model, concurrency), start=1):
+        slots[idx] = res
+        progress.progress(done / len(sections))
+        placeholder.json([r for r in slots if r is not None])
+        while next_row < len(slots) and slots[next_row] is not None:
+            write_csv_stance_item(csv_writer, slots[next_row])
+            next_row += 1
+    stance_results = slots
+    retries = retry_stats_since(stats_before, model)
+    if retries:
+        st.caption(f"Gemini retries ({retries})")
+    # Kept in session state: clicking a download button reruns the script without "Run"
+    st.session_state["segmentation"] = segmentation
+    st.session_state["stance_results"] = stance_results
+    st.session_state["stance_csv"] = csv_buf.getvalue().encode("utf-8")
+    st.session_state["results_pdf_hash"] = upload_hash
+elif "stance_results" in st.session_state:
+    st.json(st.session_state["segmentation"])
     st.subheader("Stance Results")
-    st.json(stance_results)
+    st.json(st.session_state["stance_results"])
 
-    if st.button("Download JSON"):
-        save_json(segmentation, "segmentation.json")
-        save_json(stance_results, "stance.json")
-        save_csv_stance(stance_results, "stance.csv")
-        st.success("Saved segmentation.json, stance.json, stance.csv in working directory.")
+if "stance_results" in st.session_state:
+    st.download_button(
+        "Download segmentation.json",
+        data=dumps(st.session_state["segmentation"]),
+        file_name="segmentation.json",
+        mime="application/json",
+    )
+    st.download_button(
+        "Download stance.json",
+        data=dumps(st.session_state["stance_results"]),
+        file_name="stance.json",
+        mime="application/json",
+    )
+    st.download_button(
+        "Download stance.csv",
+        data=st.session_state["stance_csv"],
+        file_name="stance.csv",
+        mime="text/csv",
+    )
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import src.ai_clients as ai_clients
+from src.ai_clients import GeminiClient, _cache_path, _cache_read
+
+
+def test_cache_path_accepts_lone_surrogates():
+    path = _cache_path("m", None, "text \ud835", 0.2)
+    assert path.endswith(".json")
+    assert path != _cache_path("m", None, "text ", 0.2)
+
+
+def _stub_client(monkeypatch, tmp_path, answer):
+    """GeminiClient without an SDK: _call_once is replaced by answer(model)."""
+    monkeypatch.setattr(ai_clients, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(ai_clients, "BASE_DELAY", 0.0)
+    monkeypatch.setattr(ai_clients, "FALLBACK_MODEL", "fallback-model")
+    client = GeminiClient.__new__(GeminiClient)
+    client.model_name = "primary-model"
+    client.mode = "new"
+    client.retry_stats = {}
+    client._stats_lock = threading.Lock()
+    client._answered = threading.local()
+    client._call_once = lambda model, contents, **kwargs: answer(model)
+    return client
+
+
+def test_fallback_answer_is_not_cached_as_primary(monkeypatch, tmp_path):
+    calls = []
+
+    def answer(model):
+        calls.append(model)
+        if model == "primary-model" and len(calls) <= ai_clients.MAX_RETRIES:
+            raise RuntimeError("503 UNAVAILABLE")
+        return '{"from": "%s"}' % model
+
+    client = _stub_client(monkeypatch, tmp_path, answer)
+    assert client.generate_json("p") == '{"from": "fallback-model"}'
+    # primary recovered: the next call asks it again instead of replaying the fallback reply
+    assert client.generate_json("p") == '{"from": "primary-model"}'
+    assert client.generate_json("p") == '{"from": "primary-model"}'
+    assert calls.count("fallback-model") == 1
+    assert _cache_read(_cache_path("fallback-model", None, "p", 0.2)) == '{"from": "fallback-model"}'
+
+
+def _flaky(errors, result="ok"):
+    """Stub fn raising each error in turn, then returning result; records its calls."""
+    calls = []
+
+    def fn(model):
+        calls.append(model)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return fn, calls
+
+
+def test_retry_wrapper_retries_transient_errors(monkeypatch, tmp_path):
+    client = _stub_client(monkeypatch, tmp_path, lambda model: "")
+    fn, calls = _flaky([RuntimeError("503 Service Unavailable"), RuntimeError("RESOURCE_EXHAUSTED: quota")])
+    assert client._retry_wrapper(fn, "m") == "ok"
+    assert calls == ["m", "m", "m"]
+    assert client.retry_stats == {"retries": 2}
+
+
+def test_retry_wrapper_does_not_retry_other_errors(monkeypatch, tmp_path):
+    client = _stub_client(monkeypatch, tmp_path, lambda model: "")
+    fn, calls = _flaky([ValueError("400 INVALID_ARGUMENT")])
+    with pytest.raises(ValueError):
+        client._retry_wrapper(fn, "m")
+    assert calls == ["m"]
+    assert client.retry_stats == {"exhausted": 1}
+
+
+def test_retry_wrapper_calls_fallback_once_after_exhaustion(monkeypatch, tmp_path):
+    client = _stub_client(monkeypatch, tmp_path, lambda model: "")
+    fn, calls = _flaky([RuntimeError("503 UNAVAILABLE")] * ai_clients.MAX_RETRIES)
+    fallback_calls = []
+    result = client._retry_wrapper(fn, "m", fallback=lambda: fallback_calls.append(1) or "fallback")
+    assert result == "fallback"
+    assert len(calls) == ai_clients.MAX_RETRIES
+    assert fallback_calls == [1]
+    assert client.retry_stats == {"retries": ai_clients.MAX_RETRIES - 1, "exhausted": 1, "fallbacks": 1}
+
+
+def test_fallback_for_skips_same_model(monkeypatch, tmp_path):
+    client = _stub_client(monkeypatch, tmp_path, lambda model: "")
+    assert client._fallback_for(lambda model: model)() == "fallback-model"
+    monkeypatch.setattr(ai_clients, "FALLBACK_MODEL", "primary-model")
+    assert client._fallback_for(lambda model: model) is None
@@ -0,0 +1,394 @@
+import math
+import random
+import re
+import threading
+import time
+import types
+
+import orjson
+import pytest
+
+import src.analysis as analysis
+from src.analysis import _reconcile_sections, parse_json_str, run_query_on_text, slice_pages_text
+from src.pdf_utils import PageText, build_page_index, chunk_text_for_model, combine_pages_indexed, group_chunks
+
+WORDS = ["we", "may", "might", "clearly", "Data", "data", "dataset", "thesis", "é", "aa", "aaa"]
+
+
+def _random_document(rng: random.Random, n_pages: int) -> tuple[str, dict[int, tuple[int, int]]]:
+    pages = [
+        PageText(
+            page_num=i,
+            text="\n".join(" ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 12))) for _ in range(rng.randint(0, 6))),
+        )
+        for i in range(1, n_pages + 1)
+    ]
+    return combine_pages_indexed(pages)
+
+
+# Reference implementations: the original re.split-based code the current versions replace
+
+
+def _ref_slice(full_text, start_page, end_page):
+    parts = re.split(r"<<PAGE\s+(\d+)>>", full_text)
+    chunks = []
+    for i in range(1, len(parts), 2):
+        pnum = int(parts[i])
+        ptext = parts[i + 1] if i + 1 < len(parts) else ""
+        if start_page <= pnum <= end_page:
+            chunks.append(ptext.strip())
+    return "\n\n".join(chunks)
+
+
+def _ref_reconcile(items):
+    groups = {}
+    for it in items or []:
+        if not isinstance(it, dict):
+            continue
+        title = str(it.get("title", "")).strip()
+        if not title:
+            continue
+        try:
+            sp = int(it.get("start_page", 1))
+        except Exception:
+            sp = 1
+        try:
+            ep = int(it.get("end_page", sp))
+        except Exception:
+            ep = sp
+        summary = str(it.get("summary", "")).strip()
+        key = re.sub(r"\s+", " ", title.lower())
+        sp = max(1, sp)
+        ep = max(sp, ep)
+        if key not in groups:
+            groups[key] = {"title": title, "start_page": sp, "end_page": ep, "summaries": [summary] if summary else []}
+        else:
+            groups[key]["start_page"] = min(groups[key]["start_page"], sp)
+            groups[key]["end_page"] = max(groups[key]["end_page"], ep)
+            if summary:
+                groups[key]["summaries"].append(summary)
+    merged = [
+        {
+            "title": v["title"],
+            "start_page": v["start_page"],
+            "end_page": v["end_page"],
+            "summary": " ".join(v["summaries"])[:1200],
+        }
+        for v in groups.values()
+    ]
+    merged.sort(key=lambda x: (x["start_page"], x["end_page"]))
+    for i in range(1, len(merged)):
+        prev, cur = merged[i - 1], merged[i]
+        if cur["start_page"] <= prev["end_page"]:
+            cur["start_page"] = prev["end_page"] + 1
+            if cur["start_page"] > cur["end_page"]:
+                cur["end_page"] = cur["start_page"]
+    return merged
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_slice_pages_text_matches_re_split(seed):
+    rng = random.Random(seed)
+    combined, page_index = _random_document(rng, rng.randint(1, 25))
+    for _ in range(10):
+        start = rng.randint(0, 27)
+        end = rng.randint(start, 30)
+        expected = _ref_slice(combined, start, end)
+        assert slice_pages_text(combined, start, end, page_index) == expected
+        assert slice_pages_text(combined, start, end, build_page_index(combined)) == expected
+        assert slice_pages_text(combined, start, end) == expected
+
+
+def _query_spec(keywords, case_sensitive, any_all="any"):
+    return {
+        "strategy": {
+            "mode": "keywords",
+            "case_sensitive": case_sensitive,
+            "context_before_chars": 15,
+            "context_after_chars": 15,
+            "keywords": keywords,
+            "any_all": any_all,
+        },
+        "fields": [{"name": "term"}],
+    }
+
+
+@pytest.mark.skipif(analysis.ahocorasick is None, reason="pyahocorasick not installed")
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("case_sensitive", [False, True])
+@pytest.mark.parametrize("any_all", ["any", "all"])
+def test_ahocorasick_scan_matches_regex_scan(monkeypatch, seed, case_sensitive, any_all):
+    rng = random.Random(seed)
+    combined, page_index = _random_document(rng, 15)
+    # overlapping and prefix-sharing keywords exercise the non-overlapping-per-keyword rule
+    spec = _query_spec(["data", "aa", "aaa", "we may", "É"], case_sensitive, any_all)
+    with_ac = run_query_on_text(combined, spec, page_index)
+    monkeypatch.setattr(analysis, "ahocorasick", None)
+    assert with_ac == run_query_on_text(combined, spec, page_index)
+
+
+def test_reconcile_sections_matches_reference():
+    rng = random.Random(0)
+    page_values = [1, 3, 7, 12, "4", " 9 ", "x", "", None, -2, 0, 5.0, 8.9]
+    for _ in range(200):
+        items = [
+            {
+                "title": rng.choice(["Intro", "intro", " Intro ", "Methods", "Results  and Discussion", "results and discussion", ""]),
+                "start_page": rng.choice(page_values),
+                "end_page": rng.choice(page_values),
+                "summary": rng.choice(["", "short", "long " * 400]),
+            }
+            for _ in range(rng.randint(0, 8))
+        ]
+        items.append("not a dict")
+        assert _reconcile_sections(items) == _ref_reconcile(items)
+
+
+@pytest.mark.parametrize("value", [math.nan, math.inf, -math.inf])
+def test_reconcile_sections_non_finite_pages(value):
+    merged = _reconcile_sections([{"title": "Intro", "start_page": value, "end_page": value}])
+    assert merged == [{"title": "Intro", "start_page": 1, "end_page": 1, "summary": ""}]
+
+
+def test_reconcile_sections_nan_from_model_output():
+    items = parse_json_str('[{"title": "Intro", "start_page": NaN, "end_page": 4}, {"title": "Body", "start_page": 3}]')
+    assert _reconcile_sections(items) == [
+        {"title": "Intro", "start_page": 1, "end_page": 4, "summary": ""},
+        {"title": "Body", "start_page": 5, "end_page": 5, "summary": ""},
+    ]
+
+
+def test_reconcile_sections_empty():
+    assert _reconcile_sections(None) == []
+    assert _reconcile_sections([]) == []
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"a": 1}', {"a": 1}),
+        ('```json\n[1, 2]\n```', [1, 2]),
+        ('Sure, here it is: {"a": "x}]", "b": [1, {"c": 2}]} hope it helps', {"a": "x}]", "b": [1, {"c": 2}]}),
+        ('prefix ["q\\"]", 2] suffix', ['q"]', 2]),
+    ],
+)
+def test_parse_json_str(text, expected):
+    assert parse_json_str(text) == expected
+
+
+def test_parse_json_str_truncated():
+    with pytest.raises(ValueError):
+        parse_json_str('{"hedges": [ truncated')
+
+
+def test_failed_chunk_is_flagged_and_not_memoised():
+    ok = analysis._parse_stance("T", '{"hedges": [{"word": "may", "sentence": "s"}], "summary": "fine"}')
+    bad = analysis._parse_stance("T", '{"hedges": [ truncated')
+    assert bad["parse_failed"] and not ok.get("parse_failed")
+
+    merged = analysis._merge_stance("T", [ok, bad])
+    assert merged["parse_failed"]
+    assert merged["summary"] == "fine"
+    assert merged["hedges"] == [{"word": "may", "sentence": "s"}]
+
+    analysis._memo_put("partial-key", merged)
+    assert analysis._memo_get("partial-key") is None
+    assert analysis._merge_stance("T", [bad, bad])["summary"] == "Parsing failed"
+
+
+def test_retry_stats_since_reports_only_new_counts(monkeypatch):
+    client = types.SimpleNamespace(retry_stats={"retries": 2}, _stats_lock=threading.Lock())
+    monkeypatch.setattr(analysis, "_get_client", lambda model_name=None: client)
+    before = analysis.retry_stats()
+    assert analysis.retry_stats_since(before) == ""
+    client.retry_stats.update(retries=5, fallbacks=1)
+    assert analysis.retry_stats_since(before) == "fallbacks: 1, retries: 3"
+
+
+class StubClient:
+    """Stands in for GeminiClient: answer(prompt) gives the response; tracks requests in flight."""
+
+    def __init__(self, answer=None, delay: float = 0.0):
+        self.answer = answer or (lambda prompt: '{"hedges": [], "summary": "ok"}')
+        self.delay = delay
+        self.prompts: list[str] = []
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def generate_json(self, prompt, system_instruction=None, **kwargs):
+        with self._lock:
+            self.prompts.append(prompt)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.delay(prompt) if callable(self.delay) else self.delay)
+            return self.answer(prompt)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def generate_json_batch(self, prompts, **kwargs):
+        return [self.generate_json(p, s) for p, s in prompts]
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    def install(client: StubClient) -> StubClient:
+        monkeypatch.setattr(analysis, "_get_client", lambda model_name=None: client)
+        return client
+
+    monkeypatch.setattr(analysis, "BATCH_MODE", False)
+    analysis._stance_memo.clear()
+    yield install
+    analysis._stance_memo.clear()
+
+
+def _sent_text(prompt: str) -> str:
+    return prompt.split("TEXT:\n", 1)[1]
+
+
+CUES = "We may argue that this clearly matters. "
+
+
+def test_needs_stance():
+    assert analysis._needs_stance("Introduction", CUES * 3)
+    assert not analysis._needs_stance("Introduction", "The data were collected in 2020. " * 50)
+    for title in ["References", "  bibliography ", "Appendices", "Appendix."]:
+        assert not analysis._needs_stance(title, CUES * 10)
+
+
+def test_prefiltered_section_makes_no_call(stub):
+    client = stub(StubClient())
+    res = analysis.ai_analyse_stance("References", CUES * 10)
+    assert res["summary"] == "Skipped by stance prefilter"
+    assert all(res[cat] == [] for cat in analysis.STANCE_CATEGORIES)
+    assert client.prompts == []
+
+
+def test_fit_token_budget():
+    short = "x" * 1000
+    assert analysis._fit_token_budget(short, max_tokens=1000) is short
+    text = "".join(chr(65 + i % 26) for i in range(100_000))
+    out = analysis._fit_token_budget(text, max_tokens=5000)
+    head = int(20_000 * 0.4)
+    assert out.startswith(text[:head])
+    assert out.endswith(text[-head:])
+    assert out.count("[...]") == 2
+    assert len(out) == 20_000 + 2 * len("\n\n[...]\n\n")
+
+
+def test_salient_text_keeps_cue_windows():
+    filler = "lorem ipsum dolor sit amet " * 200
+    text = (filler + "this may be so. ") * 10
+    assert len(text) > analysis.STANCE_SALIENCE_CHARS
+    out = analysis._salient_text(text)
+    assert len(out) < len(text) // 10
+    assert out.count("may") == 10
+    assert out.count("… [gap] …") == 9
+    # short sections and sections without cues go out unchanged
+    assert analysis._salient_text(filler) is filler
+    no_cues = filler * 10
+    assert analysis._salient_text(no_cues) is no_cues
+
+
+def test_salient_text_merges_overlapping_windows():
+    text = "x" * 40_000 + " we may " + "y" * 100 + " clearly " + "z" * 40_000
+    out = analysis._salient_text(text)
+    assert "… [gap] …" not in out
+    assert "we may " + "y" * 100 + " clearly" in out
+
+
+def test_long_section_is_chunked_within_token_budget(stub):
+    client = stub(StubClient())
+    text = "\n\n".join(f"<<PAGE {i}>>\n" + "we may " * 1400 for i in range(1, 41))
+    assert len(text) > 350_000
+    analysis.ai_analyse_stance("Literature review", text)
+    sent = [_sent_text(p) for p in client.prompts]
+    assert len(sent) > 1
+    assert all(len(s) <= analysis.STANCE_CHUNK_CHARS for s in sent)
+    overlap_allowance = analysis.STANCE_CHUNK_OVERLAP * len(sent)
+    assert sum(map(len, sent)) <= analysis.STANCE_MAX_TOKENS * 4 + overlap_allowance + 100
+
+
+def test_merge_stance_dedupes_overlap_examples():
+    a = {"section": "T", "hedges": [{"word": "may", "sentence": "s1"}, {"word": "might", "sentence": "s2"}],
+         "boosters": [], "attitude_markers": [], "self_mentions": [], "summary": "one"}
+    b = {"section": "T", "hedges": [{"word": "might", "sentence": "s2"}, {"word": "may", "sentence": "s3"}],
+         "boosters": [], "attitude_markers": [], "self_mentions": [], "summary": "two"}
+    merged = analysis._merge_stance("T", [a, b])
+    assert merged["hedges"] == [{"word": "may", "sentence": "s1"}, {"word": "might", "sentence": "s2"}, {"word": "may", "sentence": "s3"}]
+    assert merged["summary"] == "one two"
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_max_workers_caps_requests_in_flight(stub, workers):
+    client = stub(StubClient(delay=0.01))
+    long_text = "\n\n".join(f"<<PAGE {i}>>\n" + "we may " * 1400 for i in range(1, 9))
+    sections = [(f"Long {i}", long_text + str(i)) for i in range(4)] + [(f"Short {i}", CUES * 2) for i in range(6)]
+    results = list(analysis.iter_stance_ordered(sections, max_workers=workers))
+    assert len(results) == len(sections)
+    assert len(client.prompts) > len(sections)  # long sections were split into chunks
+    assert client.peak <= workers
+    if workers > 1:
+        assert client.peak > 1
+
+
+def test_length_bins():
+    assert analysis._length_bins([("a", "x"), ("b", "xx")]) == [[0, 1], [], []]
+    lengths = [5, 50_000, 300, 20, 9_000, 100, 70_000, 4_000, 60]
+    bins = analysis._length_bins([(str(i), "x" * n) for i, n in enumerate(lengths)])
+    assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+    assert all(bins)
+    for lower, upper in zip(bins, bins[1:]):
+        assert max(lengths[i] for i in lower) <= min(lengths[i] for i in upper)
+
+
+def test_iter_stance_ordered_yields_in_input_order(stub):
+    # later sections finish first
+    stub(StubClient(answer=lambda p: '{"summary": "%s"}' % p.rsplit("END", 1)[1].strip(),
+                    delay=lambda p: 0.002 * (10 - int(p.rsplit("END", 1)[1]))))
+    sections = [(f"S{i}", CUES * 2 + f"END{i}") for i in range(10)]
+    progress = []
+    results = list(analysis.iter_stance_ordered(sections, max_workers=4, progress_cb=lambda d, t: progress.append((d, t))))
+    assert [r["section"] for r in results] == [f"S{i}" for i in range(10)]
+    assert [r["summary"] for r in results] == [str(i) for i in range(10)]
+    assert progress == [(d, 10) for d in range(1, 11)]
+
+
+def test_iter_stance_results_yields_each_index_once(stub):
+    stub(StubClient())
+    sections = [(f"S{i}", CUES * 2 * (i + 1)) for i in range(7)]
+    indices = [idx for idx, _ in analysis.iter_stance_results(sections, max_workers=2)]
+    assert sorted(indices) == list(range(7))
+    assert list(analysis.iter_stance_results([])) == []
+
+
+def test_ai_segment_text_flattens_multi_chunk_answers(stub, monkeypatch):
+    monkeypatch.setattr(analysis, "SEGMENT_CHUNKS_PER_CALL", 3)
+    calls = []
+
+    def answer(prompt):
+        call = len(calls)
+        calls.append(prompt)
+        count = len(re.findall(r"---CHUNK \d+---", prompt))
+        if count == 0:
+            return '[{"title": "Single %d", "start_page": %d, "end_page": %d}]' % (call, 100 + call, 100 + call)
+        inner = [[{"title": f"C{call}-{i}", "start_page": 10 * call + i + 1, "end_page": 10 * call + i + 1}] for i in range(count)]
+        return orjson.dumps(inner).decode() if call % 2 == 0 else orjson.dumps({"chunks": inner}).decode()
+
+    stub(StubClient(answer=answer))
+    text = "\n\n".join(f"<<PAGE {i}>>\n" + "word " * 1800 for i in range(1, 41))
+    groups = group_chunks(chunk_text_for_model(text), max_per_group=3)
+    sections = analysis.ai_segment_text(text)
+    assert len(calls) == len(groups)
+    expected = sum(len(g) if len(g) > 1 else 1 for g in groups)
+    assert len(sections) == expected
+    assert [s["start_page"] for s in sections] == sorted(s["start_page"] for s in sections)
+
+
+def test_group_chunks_caps_count_and_size():
+    chunks = ["a" * 10, "b" * 10, "c" * 10, "d" * 50, "e" * 10, "f" * 10]
+    groups = group_chunks(chunks, max_chars=40, max_per_group=2)
+    assert groups == [["a" * 10, "b" * 10], ["c" * 10], ["d" * 50], ["e" * 10, "f" * 10]]
+    assert [c for g in groups for c in g] == chunks
@@ -0,0 +1,40 @@
+import io
+
+import orjson
+import pytest
+
+from src.io_utils import save_json, write_csv_stance
+
+SAMPLES = [
+    [],
+    {},
+    {"section": "Intro", "hedges": [{"word": "may", "sentence": "It may\nwork."}]},
+    [{"a": 1}],
+    [1, "two", None, [3, [4]], {"nested": {"x": [1, 2], "y": {}}}],
+    [{"section": "É", "hedges": [], "summary": "line1\nline2\t\"quoted\""} for _ in range(5)],
+]
+
+
+@pytest.mark.parametrize("data", SAMPLES)
+def test_save_json_matches_orjson_dumps(tmp_path, data):
+    path = tmp_path / "out" / "data.json"
+    save_json(data, str(path))
+    assert path.read_bytes() == orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+
+def test_write_csv_stance_streams_generator_in_order():
+    items = (
+        {"section": f"S{i}", "hedges": [{"word": "may", "sentence": f"s{i}"}], "boosters": [], "self_mentions": [{"word": "we", "sentence": "t"}]}
+        for i in range(3)
+    )
+    buf = io.StringIO()
+    write_csv_stance(buf, items)
+    assert buf.getvalue().splitlines() == [
+        "section,category,word,sentence",
+        "S0,hedges,may,s0",
+        "S0,self_mentions,we,t",
+        "S1,hedges,may,s1",
+        "S1,self_mentions,we,t",
+        "S2,hedges,may,s2",
+        "S2,self_mentions,we,t",
+    ]
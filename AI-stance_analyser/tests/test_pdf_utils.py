@@ -0,0 +1,135 @@
+import random
+import re
+from collections import Counter
+
+import pytest
+
+from src.pdf_utils import (
+    PageText,
+    chunk_text_for_model,
+    combine_pages,
+    combine_pages_indexed,
+    detect_repeated_headers_footers,
+    remove_headers_footers_and_numbers,
+)
+
+WORDS = ["thesis", "data", "we", "may", "clearly", "results", "method", "Chapter", "x", "IV", "12"]
+
+
+def _random_pages(rng: random.Random, n_pages: int) -> list[PageText]:
+    header = rng.choice(["University of Somewhere", "PhD Thesis - 2024", ""])
+    footer = rng.choice(["Confidential draft", "J. Doe", ""])
+    pages = []
+    for i in range(1, n_pages + 1):
+        lines = []
+        if header and rng.random() < 0.8:
+            lines.append(("  " if rng.random() < 0.3 else "") + header)
+        for _ in range(rng.randint(0, 8)):
+            kind = rng.random()
+            if kind < 0.1:
+                lines.append("")
+            elif kind < 0.15:
+                lines.append(" \t ")
+            elif kind < 0.25:
+                lines.append(rng.choice([str(rng.randint(1, 300)), "xiv", "III", " 7 "]))
+            else:
+                lines.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 9))))
+        if footer and rng.random() < 0.8:
+            lines.append(footer)
+        if rng.random() < 0.5:
+            lines.append(str(i))
+        pages.append(PageText(page_num=i, text="\n".join(lines) + rng.choice(["", "\n", "\n\n"])))
+    return pages
+
+
+# Reference implementations: the original line loops the current code must reproduce
+
+
+def _ref_detect(pages, top_n_lines=2, bottom_n_lines=2):
+    top_counter, bot_counter = Counter(), Counter()
+    for p in pages:
+        lines = [ln.strip() for ln in p.text.splitlines() if ln.strip()]
+        if not lines:
+            continue
+        top = " ".join(lines[:top_n_lines])
+        bot = " ".join(lines[-bottom_n_lines:]) if len(lines) >= bottom_n_lines else ""
+        if top:
+            top_counter[top] += 1
+        if bot:
+            bot_counter[bot] += 1
+    header = next(iter(top_counter.most_common(1)), ("", 0))[0]
+    footer = next(iter(bot_counter.most_common(1)), ("", 0))[0]
+    return {"header": re.escape(header) if header else "", "footer": re.escape(footer) if footer else ""}
+
+
+def _ref_remove(pages, patterns):
+    header_re = re.compile(patterns["header"], re.IGNORECASE) if patterns.get("header") else None
+    footer_re = re.compile(patterns["footer"], re.IGNORECASE) if patterns.get("footer") else None
+    page_num_re = re.compile(r"^\s*(\d+|[ivxlcdmIVXLCDM]+)\s*$")
+    cleaned = []
+    for p in pages:
+        new_lines = []
+        for ln in p.text.splitlines():
+            s = ln.strip()
+            if not s:
+                continue
+            if header_re and header_re.search(s):
+                continue
+            if footer_re and footer_re.search(s):
+                continue
+            if page_num_re.match(s):
+                continue
+            new_lines.append(ln)
+        cleaned.append(PageText(page_num=p.page_num, text="\n".join(new_lines)))
+    return cleaned
+
+
+def _ref_combine(pages):
+    return "\n\n".join(f"<<PAGE {p.page_num}>>\n{p.text}" for p in pages)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_header_footer_detection_matches_counter(seed):
+    pages = _random_pages(random.Random(seed), random.Random(seed).randint(1, 30))
+    assert detect_repeated_headers_footers(pages) == _ref_detect(pages)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_header_footer_removal_matches_line_loop(seed):
+    pages = _random_pages(random.Random(seed), 25)
+    patterns = _ref_detect(pages)
+    got = list(remove_headers_footers_and_numbers(pages, patterns))
+    assert got == _ref_remove(pages, patterns)
+
+
+def test_header_footer_removal_without_patterns():
+    pages = _random_pages(random.Random(7), 10)
+    patterns = {"header": "", "footer": ""}
+    assert list(remove_headers_footers_and_numbers(pages, patterns)) == _ref_remove(pages, patterns)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_combine_pages_indexed_offsets(seed):
+    pages = _random_pages(random.Random(seed), 20)
+    combined, page_index = combine_pages_indexed(pages)
+    assert combined == _ref_combine(pages)
+    assert combine_pages(pages) == combined
+    assert sorted(page_index) == [p.page_num for p in pages]
+    for p in pages:
+        start, end = page_index[p.page_num]
+        assert combined[start:end] == p.text
+        assert combined[:start].endswith(f"<<PAGE {p.page_num}>>\n")
+
+
+def test_combine_pages_indexed_empty():
+    assert combine_pages_indexed([]) == ("", {})
+
+
+def test_chunks_cover_text_and_restart_at_page_anchors():
+    pages = [PageText(page_num=i, text="word " * 900) for i in range(1, 30)]
+    combined = combine_pages(pages)
+    chunks = chunk_text_for_model(combined, target_chars=10000, overlap_chars=500)
+    assert chunks[0].startswith("<<PAGE 1>>")
+    assert all(len(ch) <= 10000 for ch in chunks)
+    # cuts land on page anchors, so chunks tile the text without overlap
+    assert "".join(chunks) == combined